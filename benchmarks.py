@@ -0,0 +1,557 @@
+"""
+Microbenchmarks for the inner loops of enumeration and compression.
+Run from the directory containing the package, eg:
+    python -m ec.benchmarks enumeration
+"""
+
+from .utilities import eprint
+from .type import *
+from .program import *
+from .grammar import *
+
+from time import time
+
+
+def listGrammar():
+    from .listPrimitives import primitives
+    return Grammar.uniform(primitives())
+
+# Hand written list programs that are much longer than anything that the
+# enumerator reaches in practice, so that type inference has to thread a
+# context containing lots of bindings
+LONGLISTPROGRAMS = [
+    "(lambda (mapi (lambda (lambda (+ (* $1 $0) (index $1 (reverse (sort $2)))))) (filter (lambda (gt? $0 (sum (slice 0 3 $1)))) (++ $0 (reverse $0)))))",
+    "(lambda (reducei (lambda (lambda (lambda (++ $1 (singleton (+ $2 (mod $0 (+ 1 (index 0 $3)))))))) ) empty (mapi (lambda (lambda (negate (* $0 $1)))) (sort (++ $0 (range (sum $0)))))))",
+    "(lambda (filter (lambda (and (is-prime $0) (not (any (lambda (eq? $0 (+ $1 1))) (slice 1 (sum (range 4)) $1))))) (mapi (lambda (lambda (+ $0 (index $1 $2)))) (reverse $0))))",
+]
+
+# Other ways of writing lambdas that parse, and what they should parse to
+LAMBDASPELLINGS = [
+    ("(\\$0)", "(lambda $0)"),
+    ("(\u03bb$0)", "(lambda $0)"),
+    ("(lambda$0)", "(lambda $0)"),
+    ("(\\(\\(+ $0 $1)))", "(lambda (lambda (+ $0 $1)))"),
+    ("(\u03bb #(\u03bb(+ $0 1)))", "(lambda #(lambda (+ $0 1)))"),
+    ("(\\ (filter (lambda?) $0))", "(lambda (filter (lambda ?) $0))"),
+]
+
+
+def enumerationThroughput(g, request, lowerBound, upperBound):
+    """Returns (number of programs, seconds) for enumerating lowerBound < MDL <= upperBound"""
+    start = time()
+    n = 0
+    for _ in g.enumeration(Context.EMPTY, [], request,
+                           maximumDepth=99,
+                           lowerBound=lowerBound,
+                           upperBound=upperBound):
+        n += 1
+    return n, time() - start
+
+
+def likelihoodThroughput(g, request, programs, repetitions=100):
+    """Returns (number of likelihood calculations, seconds)"""
+    start = time()
+    for _ in range(repetitions):
+        for p in programs:
+            g.logLikelihood(request, p)
+    return repetitions*len(programs), time() - start
+
+
+def benchmarkEnumeration():
+    g = listGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+    for lowerBound, upperBound in [(0., 10.), (10., 11.), (11., 12.)]:
+        n, dt = enumerationThroughput(g, request, lowerBound, upperBound)
+        eprint("Enumerated %d programs with %.1f < MDL <= %.1f in %.2f sec: %d programs/sec"%
+               (n, lowerBound, upperBound, dt, int(n/dt)))
+
+    programs = [ Program.parse(p) for p in LONGLISTPROGRAMS ]
+    n, dt = likelihoodThroughput(g, request, programs)
+    eprint("Scored %d long list programs in %.2f sec: %d programs/sec"%
+           (n, dt, int(n/dt)))
+
+
+def benchmarkInference():
+    """Type inference for programs that bind more and more type variables"""
+    import sys
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    g = listGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+    for depth in [50, 400, 1600]:
+        # Each use of a polymorphic primitive binds fresh type variables
+        body = "$0"
+        for j in range(depth):
+            body = "(filter (lambda (gt? $0 %d)) (reverse %s))"%(j%5, body)
+        p = Program.parse("(lambda %s)"%body)
+        start = time()
+        p.infer()
+        inferring = time() - start
+        start = time()
+        g.logLikelihood(request, p)
+        scoring = time() - start
+        eprint("Program nesting %d polymorphic calls: inferred its type in %.1f ms, scored it in %.1f ms"%
+               (2*depth, 1000*inferring, 1000*scoring))
+
+
+def largeListGrammar(inventions=300):
+    """The list grammar extended with lots of small inventions, like a learned DSL late in a run"""
+    g = listGrammar()
+    requests = [arrow(tint, tint), arrow(tlist(tint), tint),
+                arrow(tlist(tint), tlist(tint)), arrow(tint, tbool)]
+    invented = []
+    for request in requests:
+        for j, (_, _, p) in enumerate(g.enumeration(Context.EMPTY, [], request, upperBound=9.)):
+            if j >= inventions//len(requests): break
+            invented.append(Invented(p))
+    return Grammar.uniform(g.primitives + invented)
+
+
+def benchmarkCandidates():
+    from .fragmentGrammar import FragmentGrammar
+    g = largeListGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+    programs = [ Program.parse(p) for p in LONGLISTPROGRAMS ]
+
+    fg = FragmentGrammar.fromGrammar(g)
+    start = time()
+    repetitions = 10
+    for _ in range(repetitions):
+        fg.clearCache()
+        for p in programs: fg.logLikelihood(request, p)
+    dt = time() - start
+    eprint("Fragment grammar with %d productions scored %d long list programs in %.2f sec: %d programs/sec"%
+           (len(fg), repetitions*len(programs), dt, int(repetitions*len(programs)/dt)))
+
+    start = time()
+    for _ in range(repetitions):
+        g = Grammar(g.logVariable, g.productions)
+        for p in programs: g.logLikelihood(request, p)
+    dt = time() - start
+    eprint("Fresh grammar with %d productions scored %d long list programs in %.2f sec: %d programs/sec"%
+           (len(g), repetitions*len(programs), dt, int(repetitions*len(programs)/dt)))
+
+
+def benchmarkBestFirst():
+    g = listGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+    upperBound = 12.
+    # What enumerateForTask does: iterative deepening one nat at a time
+    start = time()
+    n = 0
+    for budget in range(int(upperBound)):
+        n += enumerationThroughput(g, request, float(budget), budget + 1.)[0]
+    dt = time() - start
+    eprint("Iterative deepening enumerated %d programs with MDL <= %.1f in %.2f sec: %d programs/sec"%
+           (n, upperBound, dt, int(n/dt)))
+
+    start = time()
+    n = 0
+    for _ in g.bestFirstEnumeration(request, upperBound=upperBound): n += 1
+    dt = time() - start
+    eprint("Best first enumerated %d programs with MDL <= %.1f in %.2f sec: %d programs/sec"%
+           (n, upperBound, dt, int(n/dt)))
+
+
+def evaluationThroughput(programs, inputs, compiled, repetitions=10):
+    """Returns (number of program evaluations, seconds), evaluating each program on each input"""
+    start = time()
+    n = 0
+    for _ in range(repetitions):
+        for p in programs:
+            f = p.compile()([]) if compiled else p.evaluate([])
+            for x in inputs:
+                try: f(x)
+                except: pass
+                n += 1
+    return n, time() - start
+
+
+def benchmarkEvaluation():
+    import random
+    from .listPrimitives import primitives
+    from .textPrimitives import primitives as textPrimitives
+    random.seed(0)
+    listInputs = [ [ random.randint(0, 9) for _ in range(random.randint(0, 10)) ]
+                   for _ in range(15) ]
+    textInputs = [ list("%s-%s.%s"%(w, w.upper(), w[::-1])) for w in
+                   ["alpha", "beta", "Gamma", "delta epsilon", "zeta,eta", ""] ]
+    for domain, g, request, inputs in [("list", listGrammar(), arrow(tlist(tint), tlist(tint)), listInputs),
+                                       ("text", Grammar.uniform(primitives() + textPrimitives),
+                                        arrow(tstr, tstr), textInputs)]:
+        programs = [ p for _, _, p in g.enumeration(Context.EMPTY, [], request, upperBound=11.) ]
+        for compiled in [False, True]:
+            n, dt = evaluationThroughput(programs, inputs, compiled)
+            eprint("%s evaluation of %d %s programs on %d inputs in %.2f sec: %d evaluations/sec"%
+                   ("Compiled" if compiled else "Tree walking",
+                    len(programs), domain, len(inputs), dt, int(n/dt)))
+
+
+def benchmarkScoring():
+    from .makeListTasks import make_list_bootstrap_tasks
+    from .likelihoodModel import AllOrNothingLikelihoodModel
+    g = listGrammar()
+    model = AllOrNothingLikelihoodModel()
+    for task in make_list_bootstrap_tasks()[:8]:
+        # In the order that the enumerator produces them
+        programs = [ p for _, _, p in g.enumeration(Context.EMPTY, [], task.request,
+                                                    maximumDepth=99, upperBound=12.) ]
+        # Batched first, so that it doesn't benefit from programs having been compiled
+        start = time()
+        many = []
+        for j in range(0, len(programs), 64):
+            many += model.scoreMany(programs[j:j + 64], task)
+        dt2 = time() - start
+        start = time()
+        one = [ model.score(p, task) for p in programs ]
+        dt1 = time() - start
+        assert one == many
+        eprint("%s: scored %d programs one at a time in %.3f sec, 64 at a time in %.3f sec (%.1fx)"%
+               (task.name, len(programs), dt1, dt2, dt1/dt2))
+
+
+def benchmarkTimeouts():
+    from .makeListTasks import make_list_bootstrap_tasks
+    from .task import EVALUATIONTIMER
+    g = listGrammar()
+    task = make_list_bootstrap_tasks()[6]
+    programs = [ p for _, _, p in g.enumeration(Context.EMPTY, [], task.request,
+                                                maximumDepth=99, upperBound=12.) ]
+    for p in programs: task.check(p)
+    repetitions = 10
+    timeout = 0.0005
+    for description, armed in [("no timeout", None),
+                               ("a timer per program", None),
+                               ("one timer for every program", timeout)]:
+        start = time()
+        with EVALUATIONTIMER.armed(armed):
+            for _ in range(repetitions):
+                for p in programs: task.check(p, None if description == "no timeout" else timeout)
+        dt = time() - start
+        eprint("Checked %d programs with %s in %.2f sec: %d programs/sec"%
+               (repetitions*len(programs), description, dt, int(repetitions*len(programs)/dt)))
+
+
+def benchmarkSharing():
+    import tracemalloc
+    g = listGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+    strings = [ str(p) for _, _, p in g.enumeration(Context.EMPTY, [], request,
+                                                  maximumDepth=99, upperBound=11.) ]
+    tracemalloc.start()
+    # eg the same programs turning up in the frontiers of several tasks
+    frontiers = [ [ Program.parse(s) for s in strings ] for _ in range(5) ]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    eprint("%d programs parsed into 5 frontiers occupy %.2f MB"%(len(strings), allocated/1e6))
+
+
+def frontierCorpus(upperBound=9.):
+    """Programs like those in the frontiers of list tasks, as strings"""
+    from .makeListTasks import make_list_bootstrap_tasks
+    g = largeListGrammar(inventions=40)
+    requests = []
+    for task in make_list_bootstrap_tasks():
+        if task.request not in requests: requests.append(task.request)
+    return [ str(p)
+             for request in requests
+             for _, _, p in g.enumeration(Context.EMPTY, [], request,
+                                          maximumDepth=99, upperBound=upperBound) ] + \
+        LONGLISTPROGRAMS
+
+
+def benchmarkParsing():
+    corpus = frontierCorpus() + [ written for written, _ in LAMBDASPELLINGS ]
+    for written, canonical in LAMBDASPELLINGS:
+        assert Program.parse(written) == Program.parse(canonical), written
+    characters = sum(len(s) for s in corpus)
+    repetitions = 10
+    start = time()
+    for _ in range(repetitions):
+        for s in corpus: Program.parse(s)
+    dt = time() - start
+    eprint("Parsed %d programs (%d characters) %d times in %.2f sec: %d programs/sec, %d characters/sec"%
+           (len(corpus), characters, repetitions, dt,
+            int(repetitions*len(corpus)/dt), int(repetitions*characters/dt)))
+
+
+def benchmarkWire():
+    import json
+    import random
+    import struct
+    from .wireFormat import encodeMessage, decodeFrontier
+    random.seed(0)
+    g = largeListGrammar(inventions=40)
+    productions = [ p for _, _, p in g.productions ]
+    # A task with lots of big examples
+    examples = [ ([[ random.randint(0, 99) for _ in range(50) ]], [ random.randint(0, 99) for _ in range(50) ])
+                 for _ in range(500) ]
+    message = {"DSL": {"logVariable": g.logVariable,
+                       "productions": [ {"expression": str(p), "logProbability": l}
+                                        for l, _, p in g.productions ]},
+               "examples": [ {"inputs": list(xs), "output": y} for xs, y in examples ],
+               "programTimeout": 0.01, "maximumFrontier": 100, "name": "benchmark"}
+    repetitions = 20
+    for name, encode in [("JSON", json.dumps), ("binary", encodeMessage)]:
+        start = time()
+        for _ in range(repetitions): m = encode(message)
+        dt = time() - start
+        eprint("Built %s request of %d bytes in %.1f ms"%(name, len(m), 1000*dt/repetitions))
+
+    # A response with a big frontier, encoded like the solver does
+    solutions = [ p for _, _, p in g.enumeration(Context.EMPTY, [], arrow(tlist(tint), tlist(tint)),
+                                                 upperBound=9.) ][:100] + \
+                [ Program.parse(p) for p in LONGLISTPROGRAMS ]
+    jsonResponse = json.dumps({"programCount": 12345,
+                               "solutions": [ {"program": str(p), "time": 1., "logLikelihood": 0., "logPrior": -10.}
+                                              for p in solutions ]})
+    index = { p: j for j, p in enumerate(productions) }
+    def codes(p):
+        if p.isAbstraction: return [-1] + codes(p.body)
+        if p.isApplication: return [-2] + codes(p.f) + codes(p.x)
+        if p.isIndex: return [-3 - p.i]
+        return [index[p]]
+    binaryResponse = b"f" + struct.pack("<qI", 12345, len(solutions)) + \
+                     b"".join( struct.pack("<dddI%di"%len(c), 1., 0., -10., len(c), *c)
+                               for p in solutions for c in [codes(p)] )
+    for name, decode, response in [("JSON", lambda r: [ Program.parse(e["program"]) for e in json.loads(r)["solutions"] ],
+                                    jsonResponse),
+                                   ("binary", lambda r: decodeFrontier(r, productions), binaryResponse)]:
+        start = time()
+        for _ in range(repetitions): decode(response)
+        dt = time() - start
+        eprint("Decoded %s response of %d bytes holding %d programs in %.2f ms"%
+               (name, len(response), len(solutions), 1000*dt/repetitions))
+
+
+def benchmarkDaemon():
+    """Short budget windows with a new ./solver for each one, and with the solver daemon"""
+    import os
+    from .wireFormat import encodeMessage
+    from .enumeration import Command, SolverDaemon
+    if not os.path.exists("./solver"):
+        eprint("No ./solver here: build the OCaml solver first")
+        return
+    g = listGrammar()
+    job = {"examples": [ {"inputs": [[3, 1, 2]], "output": [1, 2, 3]} ],
+           "programTimeout": 0.01, "maximumFrontier": 5, "name": "benchmark",
+           "lowerBound": 0., "upperBound": 5., "budgetIncrement": 5.,
+           "streamSolutions": False, "verbose": False}
+    daemon = SolverDaemon(["./solver"])
+    DSL = SolverDaemon(["./solver"]).grammar(g)["DSL"]
+    repetitions = 50
+    for name, run in [("new solver per job",
+                       lambda: Command("./solver").run(encodeMessage(dict(job, DSL=DSL)),
+                                                       timeout=10)),
+                      ("solver daemon", lambda: daemon.run(g, job, timeout=10))]:
+        start = time()
+        for _ in range(repetitions): run()
+        dt = time() - start
+        eprint("%s: %.1f ms per job"%(name, 1000*dt/repetitions))
+    daemon.process.stdin.close()
+    daemon.process.wait()
+
+
+def _compiledTaskCount(g, tasks):
+    return len(tasks)
+
+def benchmarkCompiled():
+    """callCompiled with a grammar and the list tasks, starting a new worker for each call or reusing one"""
+    import shutil
+    import sys
+    from . import utilities
+    from .listPrimitives import primitives
+    from .makeListTasks import make_list_bootstrap_tasks
+    # Under python -m this module is __main__, which the workers can't import
+    from .benchmarks import _compiledTaskCount
+    g = Grammar.uniform(primitives())
+    tasks = make_list_bootstrap_tasks()
+    command = [shutil.which("pypy3") or sys.executable, "-m", __package__ + ".compiledDriver"]
+    eprint("Workers run", command[0])
+    repetitions = 20
+    for name, newWorkers in [("new worker per call", True), ("worker pool", False)]:
+        pool = utilities.COMPILEDWORKERS
+        start = time()
+        for _ in range(repetitions):
+            if newWorkers or utilities.COMPILEDWORKERS is pool:
+                utilities.COMPILEDWORKERS = utilities.CompiledWorkerPool(command)
+            utilities.callCompiled(_compiledTaskCount, g, tasks)
+            if newWorkers:
+                for w in utilities.COMPILEDWORKERS.idle: w.close()
+        dt = time() - start
+        for w in utilities.COMPILEDWORKERS.idle: w.close()
+        utilities.COMPILEDWORKERS = pool
+        eprint("%s: %.1f ms per call"%(name, 1000*dt/repetitions))
+
+
+def benchmarkObjectStore():
+    """Pickling a grammar and the list tasks for each of several compiled workers, with and without the store"""
+    import io
+    import pickle
+    from . import utilities
+    from .listPrimitives import primitives
+    from .makeListTasks import make_list_bootstrap_tasks
+    g = Grammar.uniform(primitives())
+    tasks = make_list_bootstrap_tasks()
+    workers = 8
+    class Referencing(pickle.Pickler):
+        def persistent_id(self, obj):
+            if utilities._isSharedWithCompiledWorkers(obj): return utilities.OBJECTSTORE.put(obj)
+            return None
+    for name, Pickler in [("pickled for every worker", pickle.Pickler), ("object store", Referencing)]:
+        start = time()
+        sent = 0
+        for _ in range(workers):
+            handle = io.BytesIO()
+            Pickler(handle).dump(((g, tasks), {}))
+            sent += len(handle.getvalue())
+        dt = time() - start
+        eprint("%s: %.1f ms and %d kB for %d workers"%(name, 1000*dt, sent//1000, workers))
+
+
+def solvedFrontiers(g, tasks, upperBound, keep=5):
+    """Frontiers of the programs with MDL <= upperBound that solve the tasks, the best keep of each"""
+    from .frontier import Frontier, FrontierEntry
+    frontiers = []
+    requests = []
+    for task in tasks:
+        if task.request not in requests: requests.append(task.request)
+    for request in requests:
+        entries = {task: [] for task in tasks if task.request == request}
+        for l, _, p in g.enumeration(Context.EMPTY, [], request,
+                                     maximumDepth=99, upperBound=upperBound):
+            for task, es in entries.items():
+                if len(es) < keep and task.check(p, None):
+                    es.append(FrontierEntry(p, logPrior=l, logLikelihood=0.))
+        frontiers += [ Frontier(es, task) for task, es in entries.items() if es ]
+    return frontiers
+
+
+def benchmarkInduction():
+    from .fragmentGrammar import FragmentGrammar
+    from .listPrimitives import primitives
+    from .makeListTasks import make_list_bootstrap_tasks
+    from .makeTextTasks import makeTasks
+    from .textPrimitives import primitives as textPrimitives
+    import random
+    random.seed(0)
+    for domain, g, tasks, upperBound in [("list", listGrammar(), make_list_bootstrap_tasks(), 11.),
+                                         ("text", Grammar.uniform(primitives() + textPrimitives),
+                                          makeTasks(), 10.)]:
+        frontiers = solvedFrontiers(g, tasks, upperBound)
+        for fragmentsPerRound in [1, 4]:
+            start = time()
+            g1, _ = FragmentGrammar.induceFromFrontiers(g, frontiers, topK=2, a=2, aic=1.,
+                                                        structurePenalty=0.001, CPUs=2,
+                                                        fragmentsPerRound=fragmentsPerRound)
+            dt = time() - start
+            inventions = len(g1) - len(g)
+            if fragmentsPerRound == 1:
+                # Each round but the last adds a fragment
+                eprint("%s: %d rounds of induction from %d frontiers in %.2f sec: %.2f rounds/sec"%
+                       (domain, inventions + 1, len(frontiers), dt, (inventions + 1)/dt))
+            eprint("%s, up to %d fragments per round: %d primitives invented in %.2f sec: %.2f sec per invention"%
+                   (domain, fragmentsPerRound, inventions, dt, dt/max(inventions, 1)))
+
+
+def benchmarkLikelihoodCache():
+    import random
+    from .fragmentGrammar import FragmentGrammar
+    from .fragmentUtilities import proposeFragmentsFromFrontiers
+    from .makeListTasks import make_list_bootstrap_tasks
+    random.seed(0)
+    g = listGrammar()
+    frontiers = solvedFrontiers(g, make_list_bootstrap_tasks(), 11., keep=20)
+    programs = [ (f.task.request, e.program) for f in frontiers for e in f ]
+    fragments = proposeFragmentsFromFrontiers(frontiers, 2)
+    uniform = FragmentGrammar.fromGrammar(g).makeUniform()
+    # Every program rescored under every candidate grammar, as in the first round of induction
+    start = time()
+    for fragment in fragments:
+        candidate = FragmentGrammar.uniform(uniform.primitives + [fragment])
+        for request, p in programs: candidate.closedUses(request, p)
+    dt = time() - start
+    eprint("Scored %d programs under %d candidate grammars with a cache each in %.2f sec"%
+           (len(programs), len(fragments), dt))
+    start = time()
+    for request, p in programs: uniform.closedUses(request, p)
+    hits = sharedHits = misses = 0
+    for fragment in fragments:
+        candidate = uniform.withFragment(fragment)
+        for request, p in programs: candidate.closedUses(request, p)
+        hits += candidate.likelihoodCache.hits
+        sharedHits += candidate.likelihoodCache.sharedHits
+        misses += candidate.likelihoodCache.misses
+    dt = time() - start
+    eprint("... sharing the cache of the current grammar in %.2f sec: %d hits, %d shared hits, %d misses"%
+           (dt, hits, sharedHits, misses))
+
+
+def memoryUse(thunk):
+    """Returns (peak MB allocated by the thunk, seconds, peak RSS of the process in MB)"""
+    import resource
+    import tracemalloc
+    tracemalloc.start()
+    start = time()
+    thunk()
+    dt = time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+    return peak/1e6, dt, rss
+
+
+def benchmarkMemory():
+    from .frontier import Frontier, FrontierEntry
+    from .fragmentGrammar import FragmentGrammar
+    from .fragmentUtilities import proposeFragmentsFromFrontiers
+    from .makeListTasks import make_list_bootstrap_tasks
+    g = listGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+
+    def enumerate():
+        return [ FrontierEntry(p, logPrior=l, logLikelihood=0.)
+                 for l, _, p in g.enumeration(Context.EMPTY, [], request,
+                                              maximumDepth=99, upperBound=12.) ]
+    peak, dt, rss = memoryUse(enumerate)
+    eprint("Enumerating with MDL <= 12 allocated at most %.1f MB in %.2f sec; peak RSS %.1f MB"%
+           (peak, dt, rss))
+
+    # What each iteration of FragmentGrammar.induceFromFrontiers does
+    frontiers = []
+    for task in make_list_bootstrap_tasks()[:10]:
+        entries = [ FrontierEntry(p, logPrior=l, logLikelihood=0.)
+                    for l, _, p in g.enumeration(Context.EMPTY, [], task.request,
+                                                 maximumDepth=99, upperBound=10.) ]
+        frontiers.append(Frontier(entries[:10], task))
+    def induce():
+        for fragment in proposeFragmentsFromFrontiers(frontiers, 1)[:20]:
+            candidate = FragmentGrammar.uniform(g.primitives + [fragment])
+            candidate.insideOutside(frontiers, 1.).jointFrontiersMDL(frontiers)
+    peak, dt, rss = memoryUse(induce)
+    eprint("Proposing and scoring 20 fragments allocated at most %.1f MB in %.2f sec; peak RSS %.1f MB"%
+           (peak, dt, rss))
+
+
+BENCHMARKS = {"enumeration": benchmarkEnumeration,
+              "inference": benchmarkInference,
+              "candidates": benchmarkCandidates,
+              "bestFirst": benchmarkBestFirst,
+              "evaluation": benchmarkEvaluation,
+              "scoring": benchmarkScoring,
+              "timeouts": benchmarkTimeouts,
+              "sharing": benchmarkSharing,
+              "memory": benchmarkMemory,
+              "parsing": benchmarkParsing,
+              "wire": benchmarkWire,
+              "daemon": benchmarkDaemon,
+              "compiled": benchmarkCompiled,
+              "objectStore": benchmarkObjectStore,
+              "induction": benchmarkInduction,
+              "likelihoodCache": benchmarkLikelihoodCache}
+
+if __name__ == "__main__":
+    import sys
+    for name in sys.argv[1:] or sorted(BENCHMARKS.keys()):
+        eprint("Benchmark:", name)
+        BENCHMARKS[name]()
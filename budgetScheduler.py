@@ -0,0 +1,324 @@
+"""
+Budget windows for the enumeration jobs of multithreadedEnumeration.
+
+A job enumerates the programs of one task whose description length (MDL,
+in nats) lies in a window lowerBound < MDL <= upperBound. A scheduler
+decides which tasks get the idle workers and how wide their next windows
+are, and learns from the jobs that finish. Jobs can be recorded in a log
+(see recordSlices), and
+
+    python -m <package>.budgetScheduler LOG...
+
+replays logs through a simulation of multithreadedEnumeration to compare
+the schedulers.
+"""
+
+from .utilities import eprint, POSITIVEINFINITY
+
+from abc import ABC, abstractmethod
+from collections import defaultdict
+import json
+import math
+
+
+class BudgetScheduler(ABC):
+    def __init__(self):
+        # task -> [(lowerBound, upperBound, explored, seconds, complete)],
+        # in the order in which the jobs finished
+        self.slices = defaultdict(list)
+
+    @abstractmethod
+    def increment(self, task, lowerBound):
+        """Width of the next window of task, which starts at lowerBound"""
+
+    @abstractmethod
+    def order(self, tasks, lowerBounds):
+        """The tasks, those that should get a worker first coming first"""
+
+    def record(self, task, lowerBound, upperBound, explored, seconds, complete):
+        """A job has finished. complete: whether it enumerated its whole window."""
+        self.slices[task].append((lowerBound, upperBound, explored, seconds, complete))
+
+
+class FixedBudgetScheduler(BudgetScheduler):
+    """Fixed steps that shrink with the lower bound, lowest lower bound first"""
+    def increment(self, task, lowerBound):
+        # Very heuristic - not sure what to do here
+        if lowerBound < 24.:
+            return 1.
+        elif lowerBound < 27.:
+            return 0.5
+        else:
+            return 0.25
+
+    def order(self, tasks, lowerBounds):
+        return sorted(tasks, key=lambda t: lowerBounds[t])
+
+
+def _integralOfExponential(c, l, u):
+    """Integral of exp(c*x) for l < x < u"""
+    if abs(c) < 1e-6: return u - l
+    return (math.exp(c*u) - math.exp(c*l))/c
+
+
+class AdaptiveBudgetScheduler(BudgetScheduler):
+    """
+    Models the number of programs of a task with MDL <= b as N(b) =
+    exp(a + k*b), fitting a and k to the programs counted by the complete
+    windows of the task. The solvers walk every program with MDL <= the
+    upper bound of the window to reach those inside it, so a job costs
+    N(upperBound)/speed seconds, where we measure the speed of each task.
+    Where a task has too few jobs, the slope k and the speed are pooled
+    over the tasks that have enough. Each window is sized so that its job
+    is expected to take sliceDuration seconds, but at least doubles the
+    number of programs walked, lest we mostly revisit old ones.
+
+    Tasks are ordered by the prior probability of the programs in their
+    next window, per second of work: if a solution is distributed as the
+    prior, this is how likely the job is to find it for what it costs.
+    Tasks about which we know nothing yet come first.
+    """
+    def __init__(self, sliceDuration=5., initialIncrement=1.,
+                 minimumIncrement=0.25, maximumIncrement=4.):
+        super(AdaptiveBudgetScheduler, self).__init__()
+        self.sliceDuration = sliceDuration
+        self.initialIncrement = initialIncrement
+        self.minimumIncrement = minimumIncrement
+        self.maximumIncrement = maximumIncrement
+        # order() looks at every task, several times each, so what we
+        # fit is remembered until the slices that it depends on change.
+        # task -> cumulativeCounts / fittedSlope
+        self.counts = {}
+        self.slopes = {}
+        # Fitted to all of the tasks: "slope" and "speed"
+        self.pooled = {}
+
+    def record(self, task, lowerBound, upperBound, explored, seconds, complete):
+        super(AdaptiveBudgetScheduler, self).record(task, lowerBound, upperBound, explored, seconds, complete)
+        self.counts.pop(task, None)
+        self.slopes.pop(task, None)
+        self.pooled = {}
+
+    def cumulativeCounts(self, task):
+        """[(upper bound, N(upper bound), seconds)] for the complete windows of task starting from 0"""
+        if task in self.counts: return self.counts[task]
+        points = []
+        total = 0
+        # Jobs do not necessarily finish in the order of their windows
+        for l, u, explored, seconds, complete in sorted(self.slices[task]):
+            if not complete: break
+            total += explored
+            if total > 0: points.append((u, total, seconds))
+        self.counts[task] = points
+        return points
+
+    def fittedSlope(self, task):
+        """k fitted to the counts of task alone, or None if there are too few of them"""
+        if task not in self.slopes: self.slopes[task] = self._fitSlope(task)
+        return self.slopes[task]
+
+    def _fitSlope(self, task):
+        points = [ (b, math.log(n)) for b,n,_ in self.cumulativeCounts(task) ]
+        if len(points) < 2: return None
+        n = len(points)
+        mb = sum(b for b,_ in points)/n
+        my = sum(y for _,y in points)/n
+        variance = sum((b - mb)**2 for b,_ in points)
+        if variance == 0: return None
+        k = sum((b - mb)*(y - my) for b,y in points)/variance
+        return k if k > 0 else None
+
+    def pooledSlope(self):
+        if "slope" not in self.pooled:
+            slopes = [ k for t in self.slices for k in [self.fittedSlope(t)] if k is not None ]
+            self.pooled["slope"] = sum(slopes)/len(slopes) if slopes else None
+        return self.pooled["slope"]
+
+    def countModel(self, task):
+        """(a, k), or None if we don't know enough about task"""
+        points = self.cumulativeCounts(task)
+        if len(points) == 0: return None
+        k = self.fittedSlope(task) or self.pooledSlope()
+        if k is None: return None
+        # Through the centre of the points
+        return sum(math.log(n) - k*b for b,n,_ in points)/len(points), k
+
+    def speed(self, task):
+        """Programs walked per second for task, or None if we don't know"""
+        def measured(points):
+            walked = sum(n for _,n,_ in points)
+            seconds = sum(s for _,_,s in points)
+            if walked == 0 or seconds < 0.1: return None
+            return walked/seconds
+        s = measured(self.cumulativeCounts(task))
+        if s is None:
+            if "speed" not in self.pooled:
+                self.pooled["speed"] = measured([ p for t in self.slices for p in self.cumulativeCounts(t) ])
+            s = self.pooled["speed"]
+        return s
+
+    def increment(self, task, lowerBound):
+        model = self.countModel(task)
+        speed = self.speed(task)
+        if model is None or speed is None: return self.initialIncrement
+        a, k = model
+        # Solve N(lowerBound + d) = sliceDuration*speed
+        d = (math.log(self.sliceDuration*speed) - a)/k - lowerBound
+        d = max(d, math.log(2.)/k)
+        return min(self.maximumIncrement, max(self.minimumIncrement, d))
+
+    def hitProbabilityPerSecond(self, task, lowerBound):
+        model = self.countModel(task)
+        speed = self.speed(task)
+        if model is None or speed is None: return POSITIVEINFINITY
+        a, k = model
+        upperBound = lowerBound + self.increment(task, lowerBound)
+        # Each program with MDL b has prior probability exp(-b)
+        probability = math.exp(a)*k*_integralOfExponential(k - 1., lowerBound, upperBound)
+        seconds = math.exp(a + k*upperBound)/speed
+        return probability/seconds
+
+    def order(self, tasks, lowerBounds):
+        return sorted(tasks, key=lambda t: (-self.hitProbabilityPerSecond(t, lowerBounds[t]), lowerBounds[t]))
+
+
+SCHEDULERS = {"fixed": FixedBudgetScheduler,
+              "adaptive": AdaptiveBudgetScheduler}
+
+
+# Path of a file to which multithreadedEnumeration appends its jobs, as
+# lines of JSON. Each call starts with a line giving its parameters.
+SLICELOG = None
+def recordSlices(path):
+    global SLICELOG
+    SLICELOG = path
+
+def logSlices(*entries):
+    if SLICELOG is None: return
+    with open(SLICELOG, "a") as handle:
+        for e in entries: handle.write(json.dumps(e) + "\n")
+
+
+def loadSliceLogs(paths):
+    """Returns [(parameters, [slice])] with one entry per call to multithreadedEnumeration"""
+    episodes = []
+    for path in paths:
+        with open(path) as handle:
+            for line in handle:
+                e = json.loads(line)
+                if "enumeration" in e: episodes.append((e["enumeration"], []))
+                else: episodes[-1][1].append(e)
+    return episodes
+
+
+class RecordedTask(object):
+    """
+    What a log tells us about enumerating for a task: its counts are
+    modelled as by AdaptiveBudgetScheduler, fitted to every complete
+    window in the log, and its solutions are the ones that were found.
+    """
+    def __init__(self, name, slices, defaultModel=None, defaultSpeed=None):
+        self.name = name
+        fit = AdaptiveBudgetScheduler()
+        for s in slices:
+            fit.record(name, s["lowerBound"], s["upperBound"], s["explored"], s["seconds"], s["complete"])
+        self.model = fit.countModel(name) or defaultModel
+        self.speed = fit.speed(name) or defaultSpeed
+        self.solutions = sorted( h for s in slices for h in s["hits"] )
+
+    def programs(self, l, u):
+        if self.model is None: return 0.
+        a, k = self.model
+        return max(0., math.exp(a + k*min(u, 200.)) - math.exp(a + k*min(l, 200.)))
+
+    def seconds(self, l, u):
+        return self.programs(0., u)/self.speed
+
+
+def simulate(parameters, slices, scheduler):
+    """
+    Replays one logged call to multithreadedEnumeration with another
+    scheduler. Returns {task name: seconds of work on the task before its
+    first solution, or None if it was not solved}.
+    """
+    names = sorted({s["task"] for s in slices})
+    pooled = AdaptiveBudgetScheduler()
+    for s in slices:
+        pooled.record(s["task"], s["lowerBound"], s["upperBound"], s["explored"], s["seconds"], s["complete"])
+    slope = pooled.pooledSlope()
+    tasks = {}
+    for n in names:
+        mine = [ s for s in slices if s["task"] == n ]
+        # Without enough complete windows, assume the growth of the others
+        defaultModel = None
+        explored = sum(s["explored"] for s in mine if s["complete"])
+        if slope is not None and explored > 0:
+            u = max(s["upperBound"] for s in mine if s["complete"])
+            defaultModel = (math.log(explored) - slope*u, slope)
+        tasks[n] = RecordedTask(n, mine, defaultModel, pooled.speed(n))
+    # Nothing can be said about tasks without a complete window
+    names = [ n for n in names if tasks[n].model is not None and tasks[n].speed is not None ]
+
+    CPUs = parameters["CPUs"]
+    timeout = parameters["enumerationTimeout"]
+    maximumFrontier = parameters["maximumFrontier"]
+    lowerBounds = {n: 0. for n in names}
+    elapsed = {n: 0. for n in names}
+    found = {n: 0 for n in names}
+    firstSolution = {n: None for n in names}
+    running = [] # (finishing time, task, lowerBound, upperBound, seconds)
+    now = 0.
+
+    def active(n):
+        return found[n] < maximumFrontier and elapsed[n] < timeout
+
+    while True:
+        busy = {r[1] for r in running}
+        launchable = [ n for n in names if active(n) and n not in busy ]
+        for n in scheduler.order(launchable, lowerBounds)[:CPUs - len(running)]:
+            l = lowerBounds[n]
+            u = l + scheduler.increment(n, l)
+            seconds = min(tasks[n].seconds(l, u), timeout - elapsed[n])
+            running.append((now + seconds, n, l, u, seconds))
+            lowerBounds[n] = u
+        if len(running) == 0: break
+
+        running.sort()
+        finish, n, l, u, seconds = running.pop(0)
+        now = finish
+        complete = elapsed[n] + seconds < timeout
+        # As if the programs walked by the job came in order of MDL
+        walked = tasks[n].programs(0., u) if complete else seconds*tasks[n].speed
+        hits = [ h for h in tasks[n].solutions if l < h <= u and tasks[n].programs(0., h) <= walked ]
+        if hits and firstSolution[n] is None:
+            firstSolution[n] = elapsed[n] + tasks[n].programs(0., hits[0])/tasks[n].speed
+        found[n] += len(hits)
+        elapsed[n] += seconds
+        explored = max(0., walked - tasks[n].programs(0., l))
+        scheduler.record(n, l, u, explored, seconds, complete)
+
+    return firstSolution
+
+
+def compareSchedulers(paths, schedulers=None):
+    schedulers = schedulers or SCHEDULERS
+    episodes = loadSliceLogs(paths)
+    for name, makeScheduler in sorted(schedulers.items()):
+        solved = 0
+        total = 0
+        searchTimes = []
+        for parameters, slices in episodes:
+            if len(slices) == 0: continue
+            for _, t in simulate(parameters, slices, makeScheduler()).items():
+                total += 1
+                if t is not None:
+                    solved += 1
+                    searchTimes.append(t)
+        eprint("%s: solved %d/%d tasks, average search time %s"%
+               (name, solved, total,
+                "%.2f sec"%(sum(searchTimes)/len(searchTimes)) if searchTimes else "-"))
+
+
+if __name__ == "__main__":
+    import sys
+    compareSchedulers(sys.argv[1:])
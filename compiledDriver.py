@@ -1,19 +1,46 @@
+import os
+import signal
 import sys
 import time
 import traceback
 import pickle as pickle
 
 from .utilities import eprint
+from .task import EVALUATIONTABLE
+from . import enumeration
 
 
-if __name__ == "__main__":
-    sys.setrecursionlimit(10000)
+# Objects that were shipped through utilities.OBJECTSTORE, by digest
+SHARED = {}
+STORE = None
+
+class Unpickler(pickle.Unpickler):
+    def persistent_load(self, digest):
+        obj = SHARED.get(digest)
+        if obj is None:
+            with open(os.path.join(STORE, digest), "rb") as handle:
+                obj = SHARED[digest] = pickle.load(handle)
+            SHAREDKEYS[id(obj)] = digest
+        return obj
+
+# Shared objects go back as their digest
+SHAREDKEYS = {}
+
+class Pickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        digest = SHAREDKEYS.get(id(obj))
+        if digest is not None and SHARED.get(digest) is obj: return digest
+        return None
 
-    start = time.time()
-    request = pickle.load(sys.stdin.buffer)
-    dt = time.time() - start
-    if dt > 1:
-        eprint("(compiled driver warning: SLOW) Compiled driver unpacked the message in time", dt)
+def serve(request):
+    path, capacity = request.get("evaluationCache", (None, None))
+    EVALUATIONTABLE.useSharedStore(path, capacity)
+
+    if request.get("streamKeyword") is not None:
+        def stream(*arguments):
+            Pickler(sys.stdout.buffer).dump(("stream", arguments))
+            sys.stdout.buffer.flush()
+        request["keywordArguments"][request["streamKeyword"]] = stream
 
     response = (False, None)
     try:
@@ -27,8 +54,39 @@ if __name__ == "__main__":
         sys.stderr.write(traceback.format_exc())
         sys.stderr.flush()
     finally:
+        # Once our answer is out, any request to stop is meant for the next one
+        enumeration.ENUMERATIONCANCELLED = False
         start = time.time()
-        pickle.dump(response, sys.stdout.buffer)
+        Pickler(sys.stdout.buffer).dump(response)
+        sys.stdout.buffer.flush()
         dt = time.time() - start
         if dt > 1:
             eprint("(compiled driver warning: SLOW) Compiled driver packed the message in time", dt)
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(10000)
+
+    # Requests come one after the other until our stdin is closed. Each
+    # is preceded by where the shared objects are stored, and the digests
+    # of those that can be dropped.
+    # Whoever launched us may ask us to stop early with SIGUSR1, possibly
+    # before we have even read the request. We listen for it the way
+    # enumeration workers do, so enumerateForTask stops straight away if
+    # it was asked to while we were unpickling its request.
+    while True:
+        signal.signal(signal.SIGUSR1, enumeration._cancelEnumeration)
+
+        try: STORE, forgotten = pickle.load(sys.stdin.buffer)
+        except EOFError: break
+        for digest in forgotten:
+            obj = SHARED.pop(digest, None)
+            if obj is not None: SHAREDKEYS.pop(id(obj), None)
+
+        start = time.time()
+        request = Unpickler(sys.stdin.buffer).load()
+        dt = time.time() - start
+        if dt > 1:
+            eprint("(compiled driver warning: SLOW) Compiled driver unpacked the message in time", dt)
+
+        serve(request)
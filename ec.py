@@ -9,6 +9,7 @@ from .task import *
 from .enumeration import *
 from .grammar import *
 from .fragmentGrammar import *
+from .budgetScheduler import recordSlices
 import baselines
 import dill
 
@@ -94,7 +95,20 @@ def ecIterator(grammar, tasks,
                maximumFrontier=None,
                pseudoCounts=1.0, aic=1.0,
                structurePenalty=0.001, arity=0,
+               # Most fragments added by each round of compression
+               fragmentsPerRound=None,
                evaluationTimeout=0.05, # seconds
+               # Path of an on disk store backing the evaluation cache,
+               # shared by enumeration workers and across iterations
+               evaluationCache=None,
+               # Path of a file to which the jobs of each enumeration are
+               # appended, for replaying with budgetScheduler.py
+               enumerationLog=None,
+               # How the budget of each task is split into jobs: "fixed" or "adaptive"
+               budgetScheduler=None,
+               # Skip programs that behave like cheaper ones on the
+               # examples (python & pypy solvers)
+               observationalEquivalence=None,
                CPUs=1,
                cuda=False,
                message="",
@@ -114,6 +128,10 @@ def ecIterator(grammar, tasks,
     if benchmark is not None and resume is None:
         eprint("You cannot benchmark unless you are loading a checkpoint, aborting.")
         assert False
+    if evaluationCache is not None:
+        EVALUATIONTABLE.useSharedStore(evaluationCache)
+    if enumerationLog is not None:
+        recordSlices(enumerationLog)
 
     # We save the parameters that were passed into EC
     # This is for the purpose of exporting the results of the experiment
@@ -122,7 +140,8 @@ def ecIterator(grammar, tasks,
                                "message", "CPUs", "outputPrefix",
                                "resume", "resumeFrontierSize", "bootstrap",
                                "featureExtractor", "benchmark",
-                               "evaluationTimeout", "testingTasks", "compressor"} \
+                               "evaluationTimeout", "testingTasks", "compressor",
+                               "evaluationCache", "enumerationLog"} \
                   and v is not None}
     if not useRecognitionModel:
         for k in {"activation","helmholtzRatio","steps"}: del parameters[k]
@@ -233,7 +252,9 @@ def ecIterator(grammar, tasks,
                                                     maximumFrontier=maximumFrontier,
                                                     enumerationTimeout=enumerationTimeout,
                                                     CPUs=CPUs,
-                                                    evaluationTimeout=evaluationTimeout)
+                                                    evaluationTimeout=evaluationTimeout,
+                                                    budgetScheduler=budgetScheduler,
+                                                    observationalEquivalence=observationalEquivalence or False)
         if expandFrontier and j > 0 and (not useRecognitionModel) and \
            sum(not f.empty for f in frontiers) <= result.learningCurve[-1]:
             timeout = enumerationTimeout
@@ -249,7 +270,9 @@ def ecIterator(grammar, tasks,
                                                          maximumFrontier=maximumFrontier,
                                                          enumerationTimeout=timeout,
                                                          CPUs=CPUs,
-                                                         evaluationTimeout=evaluationTimeout)
+                                                         evaluationTimeout=evaluationTimeout,
+                                                         budgetScheduler=budgetScheduler,
+                                                         observationalEquivalence=observationalEquivalence or False)
                 if any( not f.empty for f in unsolvedFrontiers ):
                     times += unsolvedTimes
                     unsolvedFrontiers = {f.task: f for f in unsolvedFrontiers }
@@ -280,7 +303,9 @@ def ecIterator(grammar, tasks,
                                                                      maximumFrontier=maximumFrontier,
                                                                      frontierSize=frontierSize,
                                                                      enumerationTimeout=enumerationTimeout,
-                                                                     evaluationTimeout=evaluationTimeout)
+                                                                     evaluationTimeout=evaluationTimeout,
+                                                                     budgetScheduler=budgetScheduler,
+                                                                     observationalEquivalence=observationalEquivalence or False)
             eprint("Recognition model enumeration results:")
             eprint(Frontier.describe(bottomupFrontiers))
 
@@ -328,6 +353,7 @@ def ecIterator(grammar, tasks,
         grammar, frontiers = induceGrammar(grammar, frontiers,
                                            topK=topK, pseudoCounts=pseudoCounts, a=arity,
                                            aic=aic, structurePenalty=structurePenalty,
+                                           fragmentsPerRound=fragmentsPerRound or 1,
                                            backend=compressor, CPUs=CPUs)
         result.grammars.append(grammar)
         eprint("Grammar after iteration %d:" % (j + 1))
@@ -443,6 +469,13 @@ def commandlineArguments(_=None,
                         default=a,
                         help="default: %d" % a,
                         type=int)
+    parser.add_argument("--fragmentsPerRound",
+                        default=None,
+                        help="""Most fragments that the python compressor adds to
+                        the grammar each time that it proposes and scores
+                        fragments, all of which must match different programs.
+                        Default: 1""",
+                        type=int)
     parser.add_argument("-c", "--CPUs",
                         default=CPUs,
                         help="default: %d" % CPUs,
@@ -459,6 +492,32 @@ def commandlineArguments(_=None,
                         maximum size of the frontier that is kept around.
                         Default: %s""" % maximumFrontier,
                         type=int)
+    parser.add_argument("--evaluationCache",
+                        help="""Path of an on disk store for cached program
+                        evaluations, shared between enumeration workers and
+                        across iterations. Only used by tasks that cache their
+                        evaluations. Default: evaluations are only cached in memory""",
+                        default=None,
+                        type=str)
+    parser.add_argument("--enumerationLog",
+                        help="""Append the budget windows searched for each
+                        task, with how long they took, to this file. Replay it
+                        with budgetScheduler.py to compare budget schedulers""",
+                        default=None,
+                        type=str)
+    parser.add_argument("--budgetScheduler",
+                        choices=["fixed", "adaptive"],
+                        default=None,
+                        help="""How the enumeration budget of each task is split
+                        into jobs: fixed steps that shrink as the budget grows,
+                        or steps fitted to how fast each task is going.
+                        Default: fixed""")
+    parser.add_argument("--observationalEquivalence",
+                        action="store_true",
+                        default=None,
+                        help="""While enumerating, skip arguments that compute the
+                        same outputs on the examples as something cheaper. Only
+                        for the python and pypy solvers. Default: off""")
     parser.add_argument("--benchmark",
                         help="""Benchmark synthesis times with a timeout of this many seconds. You must use the --resume option. EC will not run but instead we were just benchmarked the synthesis times of a learned model""",
                         type=float,
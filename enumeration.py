@@ -6,15 +6,23 @@ from .program import *
 from .grammar import *
 
 import gc
+import os
+import queue
+import signal
+import struct
 import traceback
 import subprocess
 import threading
+import weakref
+from collections import OrderedDict
 
 
 # Initialise with the command you'll want to run, eg c = Command("./solver")
 # Then c.run(msg, timeout) gives msg to c's stdin, let it run for timeout
 # seconds, then ask nicely to stop. For compatibility with the previous code,
 # this returns (r, e) as return by communicate itself.
+# msg is either a string or bytes.
+# c.stop() asks the process to stop early, exactly like the timeout does.
 class Command(object):
     def __init__(self, cmd):
         self.cmd = cmd
@@ -22,25 +30,147 @@ class Command(object):
         self.r = None
         self.e = None
 
+    def stop(self):
+        process = self.process
+        if process is None or process.poll() is not None: return
+        try: process.send_signal(signal.SIGUSR1)
+        except ProcessLookupError: pass
+
     def run(self, msg, timeout):
+        self.process = None
+        if isinstance(msg, str): msg = bytes(msg, encoding="utf-8")
         def target():
             self.process = subprocess.Popen(self.cmd,
                                             stdin=subprocess.PIPE,
                                             stdout=subprocess.PIPE)
-            self.r, self.e = self.process.communicate(bytes(msg, encoding="utf-8"))
+            self.r, self.e = self.process.communicate(msg)
 
         thread = threading.Thread(target=target)
         thread.start()
         thread.join(timeout)   # Wait for finish in less than timeout
                                # If not ready yet, then:
         if thread.is_alive():  # Ask him nicely to stop, then wait again
-            self.process.send_signal(signal.SIGUSR1)
+            self.stop()
             thread.join()
 
         return (self.r,self.e)
 
 command = Command("./solver")
 
+
+class SolverDaemon(object):
+    """
+    A long lived "./solver --server" that enumerates one job after the
+    other, so that short budget windows don't pay for starting the solver
+    and parsing the grammar every time. Jobs are wireFormat messages sent
+    in frames on its stdin, and it replies with the same frames as a
+    single ./solver run. Each grammar is sent once, along with a number
+    that names it in later jobs; the daemon keeps the last GRAMMARS of
+    them. The daemon is started when the first job is run, and again if
+    it dies or if we are in a process forked from the one that started it.
+    daemon.stop() cancels the job being run, like Command.stop().
+    """
+    GRAMMARS = 8
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.process = None
+        self.owner = None
+        # id(g) -> (weak reference to g, number that the daemon knows it by)
+        self.grammars = OrderedDict()
+        self.nextGrammar = 0
+        self.startups = 0
+        self.jobs = 0
+
+    def start(self):
+        if self.process is not None and self.owner == os.getpid() and self.process.poll() is None:
+            return
+        self.process = subprocess.Popen(self.cmd + ["--server"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.owner = os.getpid()
+        self.grammars = OrderedDict()
+        self.startups += 1
+
+    def stop(self):
+        process = self.process
+        if process is None or self.owner != os.getpid() or process.poll() is not None: return
+        try: process.send_signal(signal.SIGUSR1)
+        except ProcessLookupError: pass
+
+    def grammar(self, g):
+        """The fields of a job that give it the grammar g"""
+        key = id(g)
+        if key in self.grammars:
+            reference, number = self.grammars[key]
+            if reference() is g:
+                self.grammars.move_to_end(key)
+                return {"grammarId": number}
+        forget = [ number for reference, number in self.grammars.values() if reference() is None ]
+        self.grammars = OrderedDict((k, v) for k, v in self.grammars.items() if v[0]() is not None)
+        while len(self.grammars) >= self.GRAMMARS:
+            forget.append(self.grammars.popitem(last=False)[1][1])
+        number = self.nextGrammar
+        self.nextGrammar += 1
+        self.grammars[key] = (weakref.ref(g), number)
+        return {"grammarId": number,
+                "forgetGrammars": forget,
+                "DSL": {"logVariable": g.logVariable,
+                        "productions": [ {"expression": str(p), "logProbability": l}
+                                         for l,_,p in g.productions ]}}
+
+    def run(self, g, msg, timeout, frameCallBack=None):
+        """
+        Enumerates the job msg (a dictionary, without its grammar) with the
+        grammar g, asking the daemon to stop after timeout seconds.
+        Returns the frames that frameCallBack did not consume, the last of
+        which holds the frontier and the number of programs enumerated.
+        """
+        from .wireFormat import encodeMessage, readFrame
+        self.start()
+        msg = dict(msg)
+        msg.update(self.grammar(g))
+        msg = encodeMessage(msg)
+        self.process.stdin.write(struct.pack("<I", len(msg)) + msg)
+        self.process.stdin.flush()
+        self.jobs += 1
+
+        timer = threading.Timer(timeout, self.stop)
+        timer.start()
+        remainder = []
+        try:
+            while True:
+                frame = readFrame(self.process.stdout)
+                if frame is None or len(frame) == 0:
+                    self.process.wait()
+                    raise OSError("solver daemon exited with code %s" % self.process.returncode)
+                if frame[:1] == b"f":
+                    remainder.append(frame)
+                    return remainder
+                if frameCallBack is None or not frameCallBack(frame): remainder.append(frame)
+        finally:
+            timer.cancel()
+
+solverDaemon = SolverDaemon(["./solver"])
+
+# Receiving SIGUSR1 asks whatever enumeration is running in this process to
+# stop and report what it has found so far; this is also what the OCaml
+# solver does on SIGUSR1. Enumeration workers pass the request on to the
+# OCaml or PyPy subprocess that they are waiting on, if any.
+ENUMERATIONCANCELLED = False
+SOLVERPID = None
+def _cancelEnumeration(_1=None, _2=None):
+    global ENUMERATIONCANCELLED
+    ENUMERATIONCANCELLED = True
+    command.stop()
+    solverDaemon.stop()
+    if SOLVERPID is not None:
+        try: os.kill(SOLVERPID, signal.SIGUSR1)
+        except ProcessLookupError: pass
+def _setSolverPID(pid):
+    global SOLVERPID
+    SOLVERPID = pid
+
 def multithreadedEnumeration(g, tasks, likelihoodModel, _=None,
                              solver=None,
                              frontierSize=None,
@@ -48,21 +178,33 @@ def multithreadedEnumeration(g, tasks, likelihoodModel, _=None,
                              CPUs=1,
                              maximumFrontier=None,
                              verbose=True,
-                             evaluationTimeout=None):
-    '''g: Either a Grammar, or a map from task to grammar.'''
+                             evaluationTimeout=None,
+                             observationalEquivalence=False,
+                             budgetScheduler=None):
+    '''g: Either a Grammar, or a map from task to grammar.
+    observationalEquivalence: prune programs that behave like cheaper ones on the examples (python & pypy solvers)
+    budgetScheduler: a budgetScheduler.BudgetScheduler, or "fixed" or "adaptive". Default: fixed.
+    The adaptive scheduler aims for jobs of a twentieth of the timeout'''
     from time import time
+    from .budgetScheduler import FixedBudgetScheduler, AdaptiveBudgetScheduler, logSlices
 
     # We don't use actual threads but instead use the multiprocessing
     # library. This is because we need to be able to kill workers.
-    from multiprocessing import Process, Queue
+    from multiprocessing import Queue
 
     assert frontierSize is None, "deprecated: frontierSize"
 
     solvers = {"ocaml": solveForTask_ocaml,
                "pypy": solveForTask_pypy,
-               "python": solveForTask_python}
+               "python": solveForTask_python,
+               "bestFirst": solveForTask_bestFirst}
     assert solver in solvers, \
-        "You must specify a valid solver. options are ocaml, pypy, or python."
+        "You must specify a valid solver. options are ocaml, pypy, python, or bestFirst."
+    assert not observationalEquivalence or solver in {"python", "pypy"}, \
+        "observationalEquivalence is only supported by the python and pypy solvers, not %s."%solver
+    # Best first enumeration never revisits a program, so each task
+    # gets a single job that searches the whole budget
+    bestFirst = solver == "bestFirst"
     solver = solvers[solver]
 
     if not isinstance(g, dict): g = {t: g for t in tasks }
@@ -85,75 +227,128 @@ def multithreadedEnumeration(g, tasks, likelihoodModel, _=None,
     # Total number of evaluated programs
     totalExplored = 0
 
-    # Each worker is assigned a unique ID number
+    # Arguments evaluated and found redundant by observational equivalence
+    totalEvaluated = 0
+    totalPruned = 0
+
+    # Each job is assigned a unique ID number
     nextID = 0
 
-    # map from ID to task
+    # map from job ID to task
     workers = {}
 
+    # map from job ID to the worker process running it
+    jobWorker = {}
+
+    # IDs of jobs that have been asked to stop early
+    cancelled = set()
+
     def numberOfHits(f):
         return sum( e.logLikelihood == 0. for e in f)
 
-    def budgetIncrement(lb):
-        # Very heuristic - not sure what to do here
-        if lb < 24.:
-            return 1.
-        elif lb < 27.:
-            return 0.5
-        else:
-            return 0.25
+    def recordSearchTime(task, searchTime):
+        if bestSearchTime[task] is None:
+            eprint("(python) Got first solution to %s after %s wall clock seconds"%(task,int(searchTime+0.5)))
+            bestSearchTime[task] = searchTime
+        else: bestSearchTime[task] = min(searchTime, bestSearchTime[task])
+
+    if budgetScheduler is None or budgetScheduler == "fixed":
+        budgetScheduler = FixedBudgetScheduler()
+    elif budgetScheduler == "adaptive":
+        budgetScheduler = AdaptiveBudgetScheduler(sliceDuration=min(10., max(1., enumerationTimeout/20.)))
+    assert not isinstance(budgetScheduler, str), \
+        "Unknown budget scheduler %s. options are fixed or adaptive."%budgetScheduler
+
+    # map from job ID to (lower bound, upper bound, time of launch, timeout, maximum frontier)
+    jobWindows = {}
+
+    logSlices({"enumeration": {"CPUs": CPUs,
+                               "enumerationTimeout": enumerationTimeout,
+                               "maximumFrontier": maximumFrontier}})
 
     startTime = time()
 
     # Workers put their messages in here
     q = Queue()
 
+    # Long-lived workers, forked once with the grammars and tasks
+    # resident. Jobs only tell them which task to work on and over
+    # which budget window.
+    taskIndex = {t: j for j,t in enumerate(tasks) }
+    pool = EnumerationWorkerPool(CPUs, q,
+                                 solver=solver,
+                                 tasks=tasks,
+                                 task2grammar=task2grammar,
+                                 likelihoodModel=likelihoodModel,
+                                 evaluationTimeout=evaluationTimeout,
+                                 observationalEquivalence=observationalEquivalence)
+
     while True:
+        # A task whose whole budget has been given out is done once its last job is
         activeTasks = {t for t in activeTasks
                        if len(frontiers[t]) < maximumFrontier \
-                       and stopwatches[t].elapsed <= enumerationTimeout }
+                       and stopwatches[t].elapsed <= enumerationTimeout \
+                       and (lowerBounds[t] < POSITIVEINFINITY or t in workers.values()) }
 
         finished = len(activeTasks) == 0
 
+        # Free up workers whose task has been solved or has run out of time
+        for ID, t in workers.items():
+            if t not in activeTasks and ID not in cancelled:
+                eprint("Cancelling [%s]"%t)
+                pool.cancel(jobWorker[ID])
+                cancelled.add(ID)
+
         if not finished:
-            while len(workers) < CPUs:
-                # Sort the tasks by lower bound. Prioritize lower
-                # lower bounds to explore shorter programs first
-                for t in sorted(activeTasks, key=lambda t: lowerBounds[t])[:CPUs-len(workers)]:
+            launchable = {t for t in activeTasks if lowerBounds[t] < POSITIVEINFINITY }
+            while len(pool.idle) > 0 and len(launchable) > 0:
+                for t in budgetScheduler.order(launchable, lowerBounds)[:len(pool.idle)]:
                     thisTimeout = enumerationTimeout - stopwatches[t].elapsed
                     if not stopwatches[t].running: stopwatches[t].start()
                     eprint("Launching [%s] w/ lb = %f, timeout = %f"%(t,lowerBounds[t],thisTimeout))
-                    bi = budgetIncrement(lowerBounds[t])
-                    launchParallelProcess(wrapInThread(solver),
-                                          q=q, ID=nextID,
-                                          elapsedTime=stopwatches[t].elapsed,
-                                          g=task2grammar[t],
-                                          task=t,
-                                          lowerBound=lowerBounds[t],
-                                          upperBound=lowerBounds[t] + bi,
-                                          budgetIncrement=bi,
-                                          timeout=thisTimeout,
-                                          likelihoodModel=likelihoodModel,
-                                          evaluationTimeout=evaluationTimeout,
-                                          maximumFrontier=maximumFrontier - numberOfHits(frontiers[t]))
+                    bi = POSITIVEINFINITY if bestFirst else budgetScheduler.increment(t, lowerBounds[t])
+                    jobWindows[nextID] = (lowerBounds[t], lowerBounds[t] + bi, time(), thisTimeout,
+                                          maximumFrontier - numberOfHits(frontiers[t]))
+                    jobWorker[nextID] = pool.launch(ID=nextID,
+                                                    task=taskIndex[t],
+                                                    elapsedTime=stopwatches[t].elapsed,
+                                                    lowerBound=lowerBounds[t],
+                                                    upperBound=lowerBounds[t] + bi,
+                                                    budgetIncrement=bi,
+                                                    timeout=thisTimeout,
+                                                    maximumFrontier=jobWindows[nextID][4])
                     lowerBounds[t] += bi
+                    if lowerBounds[t] == POSITIVEINFINITY: launchable.discard(t)
                     workers[nextID] = t
                     nextID += 1
 
         if len(workers) > 0:
-            message = Bunch(q.get())
+            # Wake up once in a while to check for tasks that have run out of time
+            try: message = Bunch(q.get(timeout=1.))
+            except queue.Empty: continue
             ID = message.ID
             if message.result == "fork":
                 assert False, "Forking message is deprecated"
             elif message.result == "failure":
                 eprint("PANIC! Exception in child worker:", message.exception)
                 eprint(message.stacktrace)
+                pool.terminate()
                 assert False
+            elif message.result == "hit":
+                # Workers report each solution as soon as they find
+                # it, so that a task can be retired without waiting
+                # for the rest of the budget window
+                entry, searchTime = message.value
+                task = workers[ID]
+                recordSearchTime(task, searchTime)
+                frontiers[task] = frontiers[task].combine(Frontier([entry], task=task))
             elif message.result == "success":
-                frontier, searchTime, explored = message.value
+                frontier, searchTime, explored, (evaluated, pruned) = message.value
                 task = workers[ID]
 
                 totalExplored += explored
+                totalEvaluated += evaluated
+                totalPruned += pruned
                 if totalExplored > 0:
                     eprint("(python) Explored %d programs in %s sec. %d programs/sec. CPU load: %s."%
                            (totalExplored,
@@ -161,15 +356,25 @@ def multithreadedEnumeration(g, tasks, likelihoodModel, _=None,
                             int(float(totalExplored)/(time() - startTime)),
                             CPULoad()))
 
-                if searchTime is not None:
-                    if bestSearchTime[task] is None:
-                        eprint("(python) Got first solution to %s after %s wall clock seconds"%(task,int(searchTime+0.5)))
-                        bestSearchTime[task] = searchTime
-                    else: bestSearchTime[task] = min(searchTime, bestSearchTime[task])
+                if searchTime is not None: recordSearchTime(task, searchTime)
                 frontiers[task] = frontiers[task].combine(frontier)
 
-                # Remove the finished worker
+                lowerBound, upperBound, launched, jobTimeout, jobFrontier = jobWindows.pop(ID)
+                seconds = time() - launched
+                # Jobs that were cut short only tell us how fast we are going
+                complete = ID not in cancelled and seconds < jobTimeout and \
+                           len(frontier) < jobFrontier
+                if not bestFirst:
+                    budgetScheduler.record(task, lowerBound, upperBound, explored, seconds, complete)
+                logSlices({"task": str(task),
+                           "lowerBound": lowerBound, "upperBound": upperBound,
+                           "explored": explored, "seconds": seconds, "complete": complete,
+                           "hits": [ -e.logPrior for e in frontier ]})
+
+                # Remove the finished job and free up its worker
                 del workers[ID]
+                cancelled.discard(ID)
+                pool.release(jobWorker.pop(ID))
 
                 # stop it stopwatch if the task is no longer being
                 # worked on
@@ -178,15 +383,94 @@ def multithreadedEnumeration(g, tasks, likelihoodModel, _=None,
 
         if finished and len(workers) == 0 and q.empty(): break
 
+    pool.shutdown()
+
     eprint("Completed multithreaded enumeration for",len(tasks),"tasks in",int(time() - startTime),"s")
     pps = float(totalExplored)/(time() - startTime)
     eprint("program evaluations per second:",int(pps))
     eprint("program evaluations per CPU second:",int(pps/CPUs))
+    if observationalEquivalence:
+        eprint("Observational equivalence: evaluated %d arguments, pruned %d of them."%
+               (totalEvaluated, totalPruned))
 
     return [frontiers[t] for t in tasks], [bestSearchTime[t] for t in tasks if bestSearchTime[t] is not None ]
 
 
+class EnumerationWorkerPool(object):
+    """
+    A fixed set of enumeration workers that live for the whole call to
+    multithreadedEnumeration. Everything that is the same for every job
+    (solver, grammars, tasks, likelihood model) is inherited by the
+    workers when they are forked, so each job is just a small message
+    naming a task index and a budget window. Results come back on q.
+    """
+    def __init__(self, CPUs, q, _=None,
+                 solver=None, tasks=None, task2grammar=None,
+                 likelihoodModel=None, evaluationTimeout=None,
+                 observationalEquivalence=False):
+        from multiprocessing import Queue
+        self.jobs = [ Queue() for _ in range(CPUs) ]
+        self.processes = [ launchParallelProcess(_enumerationWorker,
+                                                 jobs=self.jobs[w], q=q,
+                                                 solver=solver,
+                                                 tasks=tasks,
+                                                 task2grammar=task2grammar,
+                                                 likelihoodModel=likelihoodModel,
+                                                 evaluationTimeout=evaluationTimeout,
+                                                 observationalEquivalence=observationalEquivalence)
+                           for w in range(CPUs) ]
+        self.idle = list(range(CPUs))
+
+    def launch(self, **job):
+        """Sends the job to an idle worker and returns the index of that worker"""
+        w = self.idle.pop()
+        self.jobs[w].put(job)
+        return w
+
+    def release(self, w):
+        self.idle.append(w)
+
+    def cancel(self, w):
+        """Asks worker w to stop its current job early. It still reports back the usual way."""
+        try: os.kill(self.processes[w].pid, signal.SIGUSR1)
+        except ProcessLookupError: pass
+
+    def shutdown(self):
+        for j in self.jobs: j.put(None)
+        for p in self.processes: p.join()
+
+    def terminate(self):
+        for p in self.processes: p.terminate()
+
+def _enumerationWorker(_=None, jobs=None, q=None,
+                       solver=None, tasks=None, task2grammar=None,
+                       likelihoodModel=None, evaluationTimeout=None,
+                       observationalEquivalence=False):
+    global ENUMERATIONCANCELLED
+    signal.signal(signal.SIGUSR1, _cancelEnumeration)
+    solver = wrapInThread(solver)
+    while True:
+        job = jobs.get()
+        if job is None:
+            if EVALUATIONTABLE.hits + EVALUATIONTABLE.storeHits + EVALUATIONTABLE.misses > 0:
+                eprint("Enumeration worker %d:"%os.getpid(), EVALUATIONTABLE)
+            return
+        task = tasks[job.pop("task")]
+        ENUMERATIONCANCELLED = False
+
+        def hitCallBack(entry, searchTime, ID=job["ID"], elapsedTime=job["elapsedTime"]):
+            q.put({"result": "hit",
+                   "ID": ID,
+                   "value": (entry, searchTime + elapsedTime)})
 
+        solver(q=q,
+               g=task2grammar[task],
+               task=task,
+               likelihoodModel=likelihoodModel,
+               evaluationTimeout=evaluationTimeout,
+               observationalEquivalence=observationalEquivalence,
+               hitCallBack=hitCallBack,
+               **job)
 
 
 
@@ -219,12 +503,31 @@ def solveForTask_ocaml(_=None,
                        lowerBound=None, upperBound=None, budgetIncrement=None,
                        timeout=None,
                        likelihoodModel=None, # FIXME: unused
-                       evaluationTimeout=None, maximumFrontier=None):
-    import json
-    message = {"DSL": {"logVariable": g.logVariable,
-                       "productions": [ {"expression": str(p), "logProbability": l}
-                                            for l,_,p in g.productions ]},
-               "examples": [{"inputs": list(xs), "output": y} for xs,y in task.examples ],
+                       evaluationTimeout=None, maximumFrontier=None,
+                       observationalEquivalence=False,
+                       hitCallBack=None):
+    from .wireFormat import decodeFrontier, decodeStreamedSolution
+    assert not observationalEquivalence, "The OCaml solver does not support observationalEquivalence."
+
+    productions = [ p for _,_,p in g.productions ]
+    def parseSolution(e):
+        p = e["program"]
+        # Remove all entries that do not type correctly
+        # This can occur because the solver tries to infer the type
+        # Sometimes it infers a type that is too general
+        if not p.canHaveType(task.request): return None
+        return FrontierEntry(program=p,
+                             logLikelihood=e["logLikelihood"],
+                             logPrior=g.logLikelihood(task.request, p))
+
+    # The solver writes each solution in its own frame as soon as it is found
+    def streamedSolution(frame):
+        e = decodeStreamedSolution(frame, productions)
+        if e is None: return False
+        entry = parseSolution(e)
+        if entry is not None: hitCallBack(entry, e["time"])
+        return True
+    message = {"examples": [{"inputs": list(xs), "output": y} for xs,y in task.examples ],
                "programTimeout": evaluationTimeout,
                # "solverTimeout": max(int(timeout + 0.5), 1),
                "maximumFrontier": maximumFrontier,
@@ -232,6 +535,7 @@ def solveForTask_ocaml(_=None,
                "lowerBound": lowerBound,
                "upperBound": upperBound,
                "budgetIncrement": budgetIncrement,
+               "streamSolutions": hitCallBack is not None,
                "verbose": True}
     if hasattr(task, 'BIC'):
         message["parameterPenalty"] = task.BIC*math.log(len(task.examples))
@@ -240,33 +544,24 @@ def solveForTask_ocaml(_=None,
     if hasattr(task, 'maxParameters') and task.maxParameters is not None:
         message["maxParameters"] = task.maxParameters
 
-    message = json.dumps(message)
-    # with open("pipe", "w") as f:
-        # f.write(message)
-    try:
-        response, error = command.run(msg=message,
-                                      timeout=max(int(timeout + 0.5), 1))
-        response = json.loads(response)
-    except OSError as exc:
-        raise exc
+    # The frames that were not streamed, the last of which is the frontier
+    response = solverDaemon.run(g, message,
+                                timeout=max(int(timeout + 0.5), 1),
+                                frameCallBack=None if hitCallBack is None else streamedSolution)
+    response = decodeFrontier(response[-1], productions)
 
     pc = response["programCount"]
-    # Remove all entries that do not type correctly
-    # This can occur because the solver tries to infer the type
-    # Sometimes it infers a type that is too general
-    response = [r for r in response["solutions"] if Program.parse(r["program"]).canHaveType(task.request) ]
-
-    frontier = Frontier([FrontierEntry(program=p,
-                                       logLikelihood=e["logLikelihood"],
-                                       logPrior=g.logLikelihood(task.request, p))
-                         for e in response
-                         for p in [Program.parse(e["program"])] ],
+    response = [ (e, entry) for e in response["solutions"]
+                 for entry in [parseSolution(e)]
+                 if entry is not None ]
+
+    frontier = Frontier([ entry for _, entry in response ],
                         task=task)
 
     if frontier.empty: searchTime = None
-    else: searchTime = min(e["time"] for e in response) + elapsedTime
+    else: searchTime = min(e["time"] for e,_ in response) + elapsedTime
 
-    return frontier, searchTime, pc
+    return frontier, searchTime, pc, (0, 0)
 
 def solveForTask_pypy(_=None,
                       elapsedTime=0.,
@@ -274,15 +569,25 @@ def solveForTask_pypy(_=None,
                       lowerBound=None, upperBound=None, budgetIncrement=None,
                       timeout=None,
                       likelihoodModel=None,
-                      evaluationTimeout=None, maximumFrontier=None):
-    return callCompiled(enumerateForTask,
-                        g,task,likelihoodModel,
-                        timeout=timeout,
-                        evaluationTimeout=evaluationTimeout,
-                        maximumFrontier=maximumFrontier,
-                        budgetIncrement=budgetIncrement,
-                        lowerBound=lowerBound,
-                        upperBound=upperBound)
+                      evaluationTimeout=None, maximumFrontier=None,
+                      observationalEquivalence=False,
+                      hitCallBack=None):
+    try:
+        return callCompiled(enumerateForTask,
+                            g,task,likelihoodModel,
+                            timeout=timeout,
+                            evaluationTimeout=evaluationTimeout,
+                            maximumFrontier=maximumFrontier,
+                            budgetIncrement=budgetIncrement,
+                            lowerBound=lowerBound,
+                            upperBound=upperBound,
+                            observationalEquivalence=observationalEquivalence,
+                            reportPruning=True,
+                            streamKeyword=None if hitCallBack is None else "hitCallBack",
+                            streamCallBack=hitCallBack,
+                            PIDCallBack=_setSolverPID)
+    finally:
+        _setSolverPID(None)
 
 def solveForTask_python(_=None,
                         elapsedTime=0.,
@@ -290,13 +595,114 @@ def solveForTask_python(_=None,
                         lowerBound=None, upperBound=None, budgetIncrement=None,
                         timeout=None,
                         likelihoodModel=None,
-                        evaluationTimeout=None, maximumFrontier=None):
+                        evaluationTimeout=None, maximumFrontier=None,
+                        observationalEquivalence=False,
+                        hitCallBack=None):
     return enumerateForTask(g,task,likelihoodModel,
                             timeout=timeout,
                             evaluationTimeout=evaluationTimeout,
                             maximumFrontier=maximumFrontier,
                             budgetIncrement=budgetIncrement,
-                            lowerBound=lowerBound, upperBound=upperBound)
+                            lowerBound=lowerBound, upperBound=upperBound,
+                            observationalEquivalence=observationalEquivalence,
+                            reportPruning=True,
+                            hitCallBack=hitCallBack)
+
+def solveForTask_bestFirst(_=None,
+                           elapsedTime=0.,
+                           g=None, task=None,
+                           lowerBound=None, upperBound=None, budgetIncrement=None,
+                           timeout=None,
+                           likelihoodModel=None,
+                           evaluationTimeout=None, maximumFrontier=None,
+                           observationalEquivalence=False,
+                           hitCallBack=None):
+    assert not observationalEquivalence, "Best first enumeration does not support observationalEquivalence."
+    return enumerateForTask(g,task,likelihoodModel,
+                            timeout=timeout,
+                            evaluationTimeout=evaluationTimeout,
+                            maximumFrontier=maximumFrontier,
+                            lowerBound=lowerBound, upperBound=upperBound,
+                            bestFirst=True,
+                            reportPruning=True,
+                            hitCallBack=hitCallBack)
+
+class ObservationalEquivalence(object):
+    """
+    Decides when an argument that the enumerator has built is redundant,
+    because it computes exactly the same outputs on the inputs of the task
+    as a different subprogram of the same type whose description length is
+    no larger. Any program using the redundant argument is no more likely
+    to solve the task than the same program using the cheaper one, which
+    we will have enumerated anyway.
+    Only arguments whose free variables are the arguments of the task
+    (that is, not underneath any other lambda) can be evaluated, and only
+    these are ever pruned.
+    Both tables keep the most recently used capacity entries. Forgetting
+    an entry only means that we prune less, or evaluate something again.
+    """
+    def __init__(self, task, timeout=None, capacity=10**5):
+        self.numberOfArguments = len(task.request.functionArguments())
+        # $0 is the last argument
+        self.environments = [ list(reversed(xs)) for xs,_ in task.examples ]
+        self.timeout = timeout
+        self.capacity = capacity
+        # (type, outputs) -> (description length, program)
+        self.cheapest = OrderedDict()
+        # The same arguments get built over and over again, so we
+        # remember what they output. program -> outputs
+        self.programOutputs = OrderedDict()
+        # Number of arguments that we evaluated, and that we found to be redundant
+        self.evaluated = 0
+        self.pruned = 0
+
+    def redundant(self, request, environment, program, descriptionLength):
+        if len(environment) != self.numberOfArguments or \
+           request.isPolymorphic or request.isArrow(): return False
+
+        if program in self.programOutputs:
+            outputs = self.programOutputs[program]
+            self.programOutputs.move_to_end(program)
+        else:
+            outputs = self.outputs(program)
+            self.remember(self.programOutputs, program, outputs)
+            self.evaluated += 1
+        if outputs is None: return False
+        key = (request, outputs)
+
+        if key in self.cheapest:
+            cheapestLength, cheapestProgram = self.cheapest[key]
+            self.cheapest.move_to_end(key)
+            if cheapestProgram == program: return False
+            if cheapestLength <= descriptionLength:
+                self.pruned += 1
+                return True
+        self.remember(self.cheapest, key, (descriptionLength, program))
+        return False
+
+    def remember(self, table, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        if len(table) > self.capacity: table.popitem(last=False)
+
+    def outputs(self, program):
+        """Hashable outputs of the program on each example, or None if it crashed or timed out"""
+        def hashable(v):
+            if isinstance(v, list): return tuple( hashable(x) for x in v )
+            return v
+
+        if self.timeout is not None and EVALUATIONTIMER.timeout is None:
+            with EVALUATIONTIMER.armed(self.timeout): return self.outputs(program)
+        try:
+            if self.timeout is not None: EVALUATIONTIMER.begin()
+            f = program.compile()
+            outputs = tuple( hashable(f(environment))
+                             for environment in self.environments )
+            hash(outputs)
+            return outputs
+        except Exception: return None
+        finally:
+            if self.timeout is not None: EVALUATIONTIMER.end()
 
 class EnumerationTimeout(Exception): pass
 def enumerateForTask(g, task, likelihoodModel, _=None,
@@ -306,25 +712,87 @@ def enumerateForTask(g, task, likelihoodModel, _=None,
                      frontierSize=None,
                      lowerBound=0.,
                      upperBound=100.,
-                     budgetIncrement=1.0, maximumFrontier=10**2):
+                     budgetIncrement=1.0, maximumFrontier=10**2,
+                     # Enumerate the whole of (lowerBound, upperBound] in
+                     # order of decreasing prior, rather than by
+                     # iterative deepening in steps of budgetIncrement
+                     bestFirst=False,
+                     # Skip over arguments that compute the same thing
+                     # on the examples as something cheaper
+                     observationalEquivalence=False,
+                     # Also return (arguments evaluated, arguments pruned)
+                     # by observational equivalence
+                     reportPruning=False,
+                     # Likelihood models that can score many programs at
+                     # once (scoreMany) get this many at a time
+                     scoringBatchSize=64,
+                     # Called with each new frontier entry, and the
+                     # time it took to find it, as soon as it is found
+                     hitCallBack=None):
     assert (timeout is not None) or (frontierSize is not None), \
         "enumerateForTask: You must provide either a timeout or a frontier size."
 
     from time import time
+    global ENUMERATIONCANCELLED
+
+    # Listen for cancellation, unless we are running inside of an
+    # enumeration worker, which is already listening for us
+    listening = threading.current_thread() is threading.main_thread() and \
+                signal.getsignal(signal.SIGUSR1) is not _cancelEnumeration
+    if listening:
+        ENUMERATIONCANCELLED = False
+        previousHandler = signal.signal(signal.SIGUSR1, _cancelEnumeration)
 
     timeUntilFirstSolution = None
     frontier = []
     starting = time()
+    if bestFirst: budgetIncrement = upperBound - lowerBound
+    # Differentiable tasks compute different things depending on their parameters
+    if observationalEquivalence and not bestFirst and not isinstance(task, DifferentiableTask):
+        observationalEquivalence = ObservationalEquivalence(task, timeout=evaluationTimeout)
+    else: observationalEquivalence = None
+
+    def score(programs):
+        """Yields (prior, program, success, likelihood)"""
+        if not hasattr(likelihoodModel, "scoreMany"):
+            for prior,_,p in programs:
+                success, likelihood = likelihoodModel.score(p, task)
+                yield prior, p, success, likelihood
+            return
+        # Programs that come out of the enumerator one after the other
+        # share a lot of structure, which scoreMany can take advantage of
+        def scoreBatch(batch):
+            scores = likelihoodModel.scoreMany([ p for _,p in batch ], task)
+            for (prior,p),(success,likelihood) in zip(batch, scores):
+                yield prior, p, success, likelihood
+        batch = []
+        for prior,_,p in programs:
+            batch.append((prior,p))
+            if len(batch) >= scoringBatchSize:
+                yield from scoreBatch(batch)
+                batch = []
+        yield from scoreBatch(batch)
+
     previousBudget = lowerBound
     budget = lowerBound + budgetIncrement
+    # One timer for every program that we evaluate, rather than one per program
+    evaluationTimer = EVALUATIONTIMER.armed(evaluationTimeout)
+    evaluationTimer.__enter__()
     try:
         totalNumberOfPrograms = 0
         while len(frontier) < maximumFrontier:
             numberOfPrograms = 0
-            for prior,_,p in g.enumeration(Context.EMPTY, [], task.request,
-                                           maximumDepth=99,
-                                           upperBound=budget,
-                                           lowerBound=previousBudget):
+            if bestFirst:
+                programs = g.bestFirstEnumeration(task.request,
+                                                  upperBound=budget,
+                                                  lowerBound=previousBudget)
+            else:
+                programs = g.enumeration(Context.EMPTY, [], task.request,
+                                         maximumDepth=99,
+                                         upperBound=budget,
+                                         lowerBound=previousBudget,
+                                         observationalEquivalence=observationalEquivalence)
+            for prior,p,success,likelihood in score(programs):
                 descriptionLength = -prior
                 # Shouldn't see it on this iteration
                 assert descriptionLength <= budget
@@ -334,36 +802,51 @@ def enumerateForTask(g, task, likelihoodModel, _=None,
                 numberOfPrograms += 1
                 totalNumberOfPrograms += 1
 
-                success, likelihood = likelihoodModel.score(p, task)
                 if success:
                     if verbose:
                         eprint("Hit",task.name,"with the program",p,"which has prior",prior,"after",time() - starting,"seconds")
                     if frontier == []: timeUntilFirstSolution = time() - starting
-                    frontier.append(FrontierEntry(program=p,
-                                                  logPrior=prior,
-                                                  logLikelihood=likelihood))
+                    entry = FrontierEntry(program=p,
+                                          logPrior=prior,
+                                          logLikelihood=likelihood)
+                    frontier.append(entry)
+                    if hitCallBack is not None: hitCallBack(entry, time() - starting)
+                    # No need to finish the budget window once we have enough
+                    if len(frontier) >= maximumFrontier: break
 
                 if timeout is not None and time() - starting > timeout:
                     raise EnumerationTimeout
+                if ENUMERATIONCANCELLED:
+                    raise EnumerationTimeout
             if verbose:
                 eprint("Enumerated %d programs of satisfying:"%(numberOfPrograms),
-                       "%d < MDL <= %d."%(int(previousBudget),int(budget)))
+                       "%.1f < MDL <= %.1f."%(previousBudget,budget))
 
             previousBudget = budget
             budget += budgetIncrement
             if verbose:
                 eprint("\tTotal elapsed time: %d seconds. Total number of programs evaluated: %d. Task: %s."% \
                        (time() - starting, totalNumberOfPrograms, task))
+                if observationalEquivalence is not None:
+                    eprint("\tObservational equivalence: evaluated %d arguments, pruned %d of them."% \
+                           (observationalEquivalence.evaluated, observationalEquivalence.pruned))
             if frontierSize is not None and totalNumberOfPrograms > frontierSize: break
-            if budget > upperBound: break
+            if bestFirst or budget > upperBound: break
     except EnumerationTimeout:
         if verbose:
             eprint("Timeout triggered after",time() - starting,"seconds for task",task)
+    finally:
+        evaluationTimer.__exit__(None, None, None)
+        if listening: signal.signal(signal.SIGUSR1, previousHandler)
 
     frontier = Frontier(frontier,
                         task=task).topK(maximumFrontier)
 
-    return frontier, timeUntilFirstSolution, numberOfPrograms
+    if reportPruning:
+        if observationalEquivalence is None: pruning = (0, 0)
+        else: pruning = (observationalEquivalence.evaluated, observationalEquivalence.pruned)
+        return frontier, timeUntilFirstSolution, totalNumberOfPrograms, pruning
+    return frontier, timeUntilFirstSolution, totalNumberOfPrograms
 
 def solveSingleTask(grammar, task, maximumBudget=15):
     if isinstance(task, DifferentiableTask):
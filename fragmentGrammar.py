@@ -9,17 +9,128 @@ from .program import *
 
 import gc
 
+from collections import OrderedDict, defaultdict
 from itertools import chain
 import time
 
+class FragmentSummary(object):
+    """
+    The terms of the likelihood of a program with a single parse: how many
+    times each production is used, and how many times each set of
+    productions was possible for a requested type. Variables are counted
+    as Index(0). Under a grammar with one more fragment, the likelihood of
+    a program that the fragment doesn't match only differs in the
+    normalizers of the requests that the fragment can be used for.
+    """
+    def __init__(self):
+        self.constant = 0.
+        self.uses = {}
+        # (possible productions, whether variables were possible, request) -> count
+        self.normalizers = {}
+
+    def record(self, actual, candidates, request):
+        variables = sum(isinstance(p, Index) for _,_,_,p in candidates)
+        if isinstance(actual, Index):
+            # The variables share the probability of a variable evenly
+            self.constant -= math.log(variables)
+            actual = Index(0)
+        self.uses[actual] = self.uses.get(actual, 0) + 1
+        key = (frozenset(p for _,_,_,p in candidates if not isinstance(p, Index)),
+               variables > 0, request)
+        self.normalizers[key] = self.normalizers.get(key, 0) + 1
+
+    def withFragment(self, fragment, isCandidate):
+        """The summary under the grammar with fragment, which doesn't match the program"""
+        s = FragmentSummary()
+        s.constant = self.constant
+        s.uses = self.uses
+        for (ps, variables, request), n in self.normalizers.items():
+            if isCandidate(request): ps = ps | {fragment}
+            key = (ps, variables, request)
+            s.normalizers[key] = s.normalizers.get(key, 0) + n
+        return s
+
+    def logLikelihood(self, logVariable, productionLikelihoods):
+        l = self.constant
+        for p, n in self.uses.items():
+            l += n*(logVariable if isinstance(p, Index) else productionLikelihoods[p])
+        for (ps, variables, _), n in self.normalizers.items():
+            z = [ productionLikelihoods[p] for p in ps ]
+            if variables: z.append(logVariable)
+            l -= n*lse(z)
+        return l
+
+    def toUses(self):
+        possibleVariables = 0.
+        possibleUses = {}
+        for (ps, variables, _), n in self.normalizers.items():
+            if variables: possibleVariables += n
+            for p in ps: possibleUses[p] = possibleUses.get(p, 0.) + n
+        return Uses(possibleVariables=possibleVariables,
+                    actualVariables=float(self.uses.get(Index(0), 0)),
+                    possibleUses=possibleUses,
+                    actualUses={p: float(n) for p,n in self.uses.items()
+                                if not isinstance(p, Index)})
+
+
+class LikelihoodCache(object):
+    """
+    Remembers FragmentGrammar._logLikelihood for the canonical types of the
+    request and environment and the expression. The most recently used
+    entries are kept, up to capacity. Each entry also keeps the requested
+    types at every node that was visited, so that a grammar with one more
+    fragment can reuse it if the fragment isn't a candidate for any of them.
+    """
+    def __init__(self, capacity=10**5):
+        self.capacity = capacity
+        self.table = OrderedDict()
+        self.hits = 0
+        # Hits in the cache of the grammar that a candidate grammar extends
+        self.sharedHits = 0
+        self.misses = 0
+
+    def __str__(self):
+        lookups = self.hits + self.sharedHits + self.misses
+        return "LikelihoodCache(%d entries, %d hits, %d hits shared between candidate grammars, %d misses: hit rate %.1f%%)"%\
+            (len(self.table), self.hits, self.sharedHits, self.misses,
+             100.*(self.hits + self.sharedHits)/max(lookups, 1))
+
+    def lookup(self, key):
+        if key in self.table:
+            self.table.move_to_end(key)
+            return self.table[key]
+        return None
+
+    def remember(self, key, value):
+        self.table[key] = value
+        self.table.move_to_end(key)
+        if len(self.table) > self.capacity: self.table.popitem(last=False)
+
+
 class FragmentGrammar(object):
-    def __init__(self, logVariable, productions):
+    def __init__(self, logVariable, productions, likelihoodCache=None):
         self.logVariable = logVariable
         self.productions = productions
-        self.likelihoodCache = {}
+        self.productionIndex = ProductionIndex(productions)
+        self.likelihoodCache = likelihoodCache if likelihoodCache is not None else LikelihoodCache()
+        # (uniform grammar, whether the fragment is a candidate for a
+        # request) if this is that grammar with one more fragment
+        self.base = None
 
     def clearCache(self):
-        self.likelihoodCache = {}
+        self.likelihoodCache = LikelihoodCache(self.likelihoodCache.capacity)
+        self.base = None
+
+    def withFragment(self, fragment):
+        """
+        This grammar, which should be uniform, with one more fragment. The
+        new grammar reuses the likelihoods that this one has cached wherever
+        the fragment couldn't have been used, and caches those it works out
+        for this one.
+        """
+        g = FragmentGrammar.uniform(self.primitives + [fragment])
+        g.base = (self, g.isCandidateFor(fragment))
+        return g
 
     def __repr__(self):
         return "FragmentGrammar(logVariable={self.logVariable}, productions={self.productions}".format(self=self)
@@ -34,7 +145,8 @@ class FragmentGrammar(object):
     def buildCandidates(self, context, environment, request):
         candidates = []
         variableCandidates = []
-        for l,t,p in self.productions:
+        if isinstance(request, TypeVariable): request = request.apply(context)
+        for l,t,p in self.productionIndex.lookup(request):
             try:
                 newContext, t = t.instantiate(context)
                 newContext = newContext.unify(t.returns(), request)
@@ -58,7 +170,7 @@ class FragmentGrammar(object):
         return [(l - z, c, t, p) for l, c, t, p in candidates]
 
     def logLikelihood(self, request, expression):
-        _,l,_ = self._logLikelihood(Context.EMPTY, [], request, expression)
+        _,l,_,_ = self._logLikelihood(Context.EMPTY, [], request, expression)
         if invalid(l):
             f = 'failures/likelihoodFailure%s.pickle'%(time() + getPID())
             eprint("PANIC: Invalid log likelihood. expression:",expression,"tp:",request,"Exported to:",f)
@@ -68,17 +180,17 @@ class FragmentGrammar(object):
         return l
 
     def closedUses(self, request, expression):
-        _,l,u = self._logLikelihood(Context.EMPTY, [], request, expression)
+        _,l,u,_ = self._logLikelihood(Context.EMPTY, [], request, expression)
         return l,u
 
     def _logLikelihood(self, context, environment, request, expression):
-        '''returns (context, log likelihood, uses)'''
+        '''returns (context, log likelihood, uses, requested types of the nodes that were visited)'''
 
         # We can cash likelihood calculations faster whenever they don't involve type inference
         # This is because they are guaranteed to not modify the context, 
         polymorphic = request.isPolymorphic or any(v.isPolymorphic for v in environment)
-        # For some reason polymorphic caching slows it down
-        shouldDoCaching = not polymorphic
+        # Polymorphic entries are keyed by canonical types and unified back into the context on a hit
+        shouldDoCaching = True
 
         # Caching
         if shouldDoCaching:
@@ -87,8 +199,16 @@ class FragmentGrammar(object):
             else:
                 inTypes = canonicalTypes([request] + environment)
             cacheKey = (tuple(inTypes), expression)
-            if cacheKey in self.likelihoodCache:
-                outTypes, l, u = self.likelihoodCache[cacheKey]
+            entry = self.likelihoodCache.lookup(cacheKey)
+            if entry is not None: self.likelihoodCache.hits += 1
+            elif self.base is not None:
+                base, isCandidate = self.base
+                entry = base.likelihoodCache.lookup(cacheKey)
+                if entry is not None and any( isCandidate(r) for r in entry[3] ): entry = None
+                if entry is not None: self.likelihoodCache.sharedHits += 1
+            if entry is None: self.likelihoodCache.misses += 1
+            else:
+                outTypes, l, u, requests = entry
                 context, instantiatedTypes = instantiateTypes(context, outTypes)
                 outRequest = instantiatedTypes[0]
                 outEnvironment = instantiatedTypes[1:]
@@ -99,11 +219,11 @@ class FragmentGrammar(object):
                     context = context.unify(request, outRequest)
                     for v,vp in zip(environment, outEnvironment):
                         context = context.unify(v, vp)                
-                return context,l,u            
+                return context,l,u,requests
         
         if request.isArrow():
             if not isinstance(expression,Abstraction):
-                return (context,NEGATIVEINFINITY,Uses.empty)
+                return (context,NEGATIVEINFINITY,Uses.empty,frozenset())
             return self._logLikelihood(context,
                                       [request.arguments[0]] + environment,
                                       request.arguments[1],
@@ -113,6 +233,9 @@ class FragmentGrammar(object):
 
         # Construct and normalize the candidate productions
         candidates = self.buildCandidates(context, environment, request)
+        requested = request.apply(context)
+        if requested.isPolymorphic: requested = canonicalTypes([requested])[0]
+        requests = {requested}
 
         # Consider each way of breaking the expression up into a
         # function and arguments
@@ -124,6 +247,67 @@ class FragmentGrammar(object):
         possibleUses = {candidate: 1. for _,_,_,candidate in candidates
                                       if not isinstance(candidate,Index)}
         
+        for candidateLikelihood, newContext, production, children in \
+                self._parses(request, expression, candidates):
+            thisLikelihood = candidateLikelihood
+            if isinstance(production, Index):
+                theseUses = Uses(possibleVariables=possibleVariables,
+                                 actualVariables=1.,
+                                 possibleUses=possibleUses.copy(),
+                                 actualUses={})
+            else:
+                theseUses = Uses(possibleVariables=possibleVariables,
+                                 actualVariables=0.,
+                                 possibleUses=possibleUses.copy(),
+                                 actualUses={production: 1.})
+
+            # Accumulate likelihood from free variables and holes and arguments
+            for freeType,freeExpression in children:
+                freeType = freeType.apply(newContext)
+                newContext, expressionLikelihood, newUses, newRequests = \
+                        self._logLikelihood(newContext, environment, freeType, freeExpression)
+                # Including the ones where it failed: with another grammar it might not
+                requests |= newRequests
+                if expressionLikelihood is NEGATIVEINFINITY:
+                    thisLikelihood = NEGATIVEINFINITY
+                    break
+                
+                thisLikelihood += expressionLikelihood
+                theseUses += newUses
+
+            if thisLikelihood is NEGATIVEINFINITY: continue
+
+            weightedUses.append((thisLikelihood,theseUses))
+            totalLikelihood = lse(totalLikelihood, thisLikelihood)
+
+            # Any of these new context objects should be equally good
+            context = newContext
+
+        requests = frozenset(requests)
+        if totalLikelihood is NEGATIVEINFINITY:
+            return context, totalLikelihood, Uses.empty, requests
+        assert weightedUses != []
+
+        allUses = Uses.join(totalLikelihood, *weightedUses)
+
+        # memoize result
+        if shouldDoCaching:
+            outTypes = [ request.apply(context) ] + [ v.apply(context) for v in environment ]
+            outTypes = canonicalTypes(outTypes)
+            entry = (outTypes, totalLikelihood, allUses, requests)
+            self.likelihoodCache.remember(cacheKey, entry)
+            if self.base is not None:
+                base, isCandidate = self.base
+                if not any( isCandidate(r) for r in requests ): base.likelihoodCache.remember(cacheKey, entry)
+
+        return context, totalLikelihood, allUses, requests
+
+    def _parses(self, request, expression, candidates):
+        """
+        The ways of building expression from one of the candidates of
+        buildCandidates, as (candidate likelihood, context, production,
+        [(type, expression)] for the holes and arguments of the production)
+        """
         for f,xs in expression.applicationParses():
             for candidateLikelihood, newContext, tp, production in candidates:
                 variableBindings = {}
@@ -152,65 +336,68 @@ class FragmentGrammar(object):
                     continue
                     #raise GrammarFailure('len(xs) != len(argumentTypes): tp={}, xs={}'.format(tp, xs))
 
+                yield candidateLikelihood, newContext, production, \
+                    list(chain(variableBindings.values(), zip(argumentTypes, xs)))
 
-                thisLikelihood = candidateLikelihood
-                if isinstance(production, Index):
-                    theseUses = Uses(possibleVariables=possibleVariables,
-                                     actualVariables=1.,
-                                     possibleUses=possibleUses.copy(),
-                                     actualUses={})
-                else:
-                    theseUses = Uses(possibleVariables=possibleVariables,
-                                     actualVariables=0.,
-                                     possibleUses=possibleUses.copy(),
-                                     actualUses={production: 1.})
-
-                # Accumulate likelihood from free variables and holes and arguments
-                for freeType,freeExpression in chain(variableBindings.values(), zip(argumentTypes, xs)):
-                    freeType = freeType.apply(newContext)
-                    newContext, expressionLikelihood, newUses = \
-                            self._logLikelihood(newContext, environment, freeType, freeExpression)
-                    if expressionLikelihood is NEGATIVEINFINITY:
-                        thisLikelihood = NEGATIVEINFINITY
-                        break
-                    
-                    thisLikelihood += expressionLikelihood
-                    theseUses += newUses
-
-                if thisLikelihood is NEGATIVEINFINITY: continue
-
-                weightedUses.append((thisLikelihood,theseUses))
-                totalLikelihood = lse(totalLikelihood, thisLikelihood)
-
-                # Any of these new context objects should be equally good
-                context = newContext
-
-        if totalLikelihood is NEGATIVEINFINITY:
-            return context, totalLikelihood, Uses.empty
-        assert weightedUses != []
-
-        allUses = Uses.join(totalLikelihood, *weightedUses)
+    def closedSummary(self, request, expression):
+        """A FragmentSummary of expression, or None if it doesn't have exactly one parse"""
+        summary = FragmentSummary()
+        if self._summarize(Context.EMPTY, [], request, expression, summary) is None: return None
+        return summary
 
-        # memoize result
-        if shouldDoCaching:
-            outTypes = [ request.apply(context) ] + [ v.apply(context) for v in environment ]
-            outTypes = canonicalTypes(outTypes)
-            self.likelihoodCache[cacheKey] = (outTypes, totalLikelihood, allUses)
+    def _summarize(self, context, environment, request, expression, summary):
+        '''Records the terms of the likelihood in summary and returns the new context, or None'''
+        if request.isArrow():
+            if not isinstance(expression,Abstraction): return None
+            return self._summarize(context,
+                                   [request.arguments[0]] + environment,
+                                   request.arguments[1],
+                                   expression.body,
+                                   summary)
 
-        return context, totalLikelihood, allUses
+        candidates = self.buildCandidates(context, environment, request)
+        parses = list(self._parses(request, expression, candidates))
+        if len(parses) != 1: return None
+        _, newContext, production, children = parses[0]
+        summary.record(production, candidates, canonicalTypes([request.apply(context)])[0])
+        for freeType,freeExpression in children:
+            newContext = self._summarize(newContext, environment, freeType.apply(newContext), freeExpression, summary)
+            if newContext is None: return None
+        return newContext
+
+    def isCandidateFor(self, production):
+        """Returns a function of a requested type saying whether production is a candidate for it"""
+        t = next( t for _,t,p in self.productions if p == production )
+        cache = {}
+        def candidate(request):
+            if request not in cache:
+                context, (r,) = instantiateTypes(Context.EMPTY, [request])
+                try:
+                    context, returns = t.instantiate(context)
+                    context.unify(returns.returns(), r)
+                    cache[request] = True
+                except UnificationFailure: cache[request] = False
+            return cache[request]
+        return candidate
 
     def expectedUses(self, frontiers):
-        likelihoods = [ [ (l + entry.logLikelihood, u)
-                         for entry in frontier
-                         for l,u in [self.closedUses(frontier.task.request, entry.program)] ]
-                        for frontier in frontiers ]
+        return FragmentGrammar.weightUses([ [ (l + entry.logLikelihood, u)
+                                              for entry in frontier
+                                              for l,u in [self.closedUses(frontier.task.request, entry.program)] ]
+                                            for frontier in frontiers ])
+
+    @staticmethod
+    def weightUses(likelihoods):
+        """likelihoods: for each frontier, [(log likelihood, uses)] of its programs"""
         zs = (lse([ l for l,_ in ls ]) for ls in likelihoods)
         return sum(math.exp(l - z)*u
                    for z,frontier in zip(zs,likelihoods)
                    for l,u in frontier)
 
     def insideOutside(self, frontiers, pseudoCounts):
-        uses = self.expectedUses(frontiers)
+        return self.fromUses(self.expectedUses(frontiers), pseudoCounts)
+
+    def fromUses(self, uses, pseudoCounts):
         return FragmentGrammar(log(uses.actualVariables + pseudoCounts)
                                - log(max(uses.possibleVariables, 1.)),
                                [ (log(uses.actualUses.get(p,0.) + pseudoCounts)
@@ -260,7 +447,13 @@ class FragmentGrammar(object):
 
     @staticmethod
     def induceFromFrontiers(g0, frontiers, _=None,
-                            topK=1, pseudoCounts=1.0, aic=1.0, structurePenalty=0.001, a=0, CPUs=1):
+                            topK=1, pseudoCounts=1.0, aic=1.0, structurePenalty=0.001, a=0, CPUs=1,
+                            fragmentsPerRound=1):
+        """
+        fragmentsPerRound: the most fragments added to the grammar by each
+        round of proposing and scoring fragments
+        """
+        induceStart = time.time()
         originalFrontiers = frontiers
         frontiers = [frontier for frontier in frontiers if not frontier.empty ]
         eprint("Inducing a grammar from",len(frontiers),"frontiers")
@@ -285,55 +478,157 @@ class FragmentGrammar(object):
                 score = float('-inf')
             return score, g
 
+        # The current grammar made uniform, which the candidate grammars
+        # extend and whose cached likelihoods they share, and under it the
+        # summaries of the programs of each restricted frontier
+        uniform = None
+        summaries = []
+        def summarizeFrontiers():
+            return parallelMap(CPUs,
+                               lambda f: [ uniform.closedSummary(f.task.request, e.program) for e in f ],
+                               restrictedFrontiers)
+
+        def fragmentScore(fragment):
+            """grammarScore of the current grammar with the fragment, rescoring
+            only the programs that the fragment might match"""
+            g = candidate = uniform.withFragment(fragment)
+            isCandidate = g.isCandidateFor(fragment)
+            programs = []
+            for frontier, frontierSummaries in zip(restrictedFrontiers, summaries):
+                programs.append([])
+                for entry, summary in zip(frontier, frontierSummaries):
+                    if summary is not None and not index.mightMatch(fragment, entry.program):
+                        summary = summary.withFragment(fragment, isCandidate)
+                        l, u = summary.logLikelihood(0., defaultdict(float)), summary.toUses()
+                    else:
+                        summary = None
+                        l, u = g.closedUses(frontier.task.request, entry.program)
+                    programs[-1].append((entry, summary, l + entry.logLikelihood, u))
+            g = g.fromUses(FragmentGrammar.weightUses([ [ (l,u) for _,_,l,u in ps ] for ps in programs ]),
+                           pseudoCounts)
+            productionLikelihoods = {p: l for l,_,p in g.productions}
+            likelihood = sum( max( entry.logLikelihood + \
+                                   (summary.logLikelihood(g.logVariable, productionLikelihoods)
+                                    if summary is not None
+                                    else g.logLikelihood(frontier.task.request, entry.program))
+                                   for entry, summary, _, _ in ps )
+                              for frontier, ps in zip(restrictedFrontiers, programs) )
+            structure = sum(fragmentSize(p) for p in g.primitives)
+            score = likelihood - aic*len(g) - structurePenalty*structure
+            lookups = [ (c.hits, c.sharedHits, c.misses)
+                        for c in [candidate.likelihoodCache, g.likelihoodCache] ]
+            candidate.clearCache()
+            g.clearCache()
+            if invalid(score):
+                score = float('-inf')
+            return score, g, [ sum(n) for n in zip(*lookups) ]
+
+        def scoreFragment(fragment):
+            """What the workers send back: (score, fragment, likelihood cache lookups)"""
+            score, _, lookups = fragmentScore(fragment)
+            return score, fragment, lookups
 
         if aic is not POSITIVEINFINITY:
             restrictedFrontiers = restrictFrontiers()
             bestScore, _ = grammarScore(bestGrammar)
+            rounds = 0
+            inventions = 0
             while True:
+                roundStart = time.time()
                 restrictedFrontiers = restrictFrontiers()
-                fragments = [ f
-                              for f in proposeFragmentsFromFrontiers(restrictedFrontiers, a, CPUs=CPUs)
+                fragments, index = proposeFragmentsFromFrontiers(restrictedFrontiers, a, CPUs=CPUs,
+                                                                 withIndex=True)
+                fragments = [ f for f in fragments
                               if not f in bestGrammar.primitives \
                               and defragment(f) not in bestGrammar.primitives ]
                 eprint("Proposed %d fragments."%len(fragments))
 
-                candidateGrammars = [ FragmentGrammar.uniform(bestGrammar.primitives + [fragment])
-                                      for fragment in fragments ]
-                if not candidateGrammars:
+                if not fragments:
                     break
 
-                scoredFragments = parallelMap(CPUs, grammarScore, candidateGrammars,
-                                              # Each process handles up to 100 grammars at a time, a "job"
-                                              chunksize=max(1,min(len(candidateGrammars)//CPUs, 100)),
-                                              # maxTasks: Maximum number of jobs allocated to a process
-                                              # This means that after evaluating this*chunk many grammars,
-                                              # we killed the process, freeing up its memory.
-                                              # In exchange we pay the cost of spawning a new process.
-                                              # We should play with this number,
-                                              # figuring out how big we can make it without
-                                              # running out of memory.
-                                              maxtasksperchild=5)
-                newScore, newGrammar = max(scoredFragments)
+                uniform = bestGrammar.makeUniform()
+                for frontier in restrictedFrontiers:
+                    for entry in frontier: uniform.closedUses(frontier.task.request, entry.program)
+                summaries = summarizeFrontiers()
+                # The workers inherit the restricted frontiers, their
+                # summaries, the index and the cached likelihoods when they
+                # are forked, and only send back the score of each fragment.
+                # Their memory is bounded by the likelihood cache, which
+                # each candidate grammar clears once it is scored.
+                scoredFragments = parallelMap(CPUs, scoreFragment, fragments,
+                                              # Each process handles up to 100 fragments at a time, a "job"
+                                              chunksize=max(1,min(len(fragments)//CPUs, 100)))
+                hits, sharedHits, misses = [ sum(n) for n in zip(*[ l for _,_,l in scoredFragments ]) ]
+                eprint("Likelihood cache while scoring: %d hits, %d hits shared between candidate grammars, %d misses"%
+                       (hits, sharedHits, misses))
+                # Best first
+                scoredFragments.sort(key=lambda sg: sg[0], reverse=True)
+                newScore, newFragment, _ = scoredFragments[0]
+                # Only the grammar of the best fragment is rebuilt
+                _, newGrammar, _ = fragmentScore(newFragment)
+                uniform = None
 
                 if newScore <= bestScore:
                     break
+                # Along with the best fragment, accept the next best ones
+                # that improve on the current grammar and might only match
+                # programs that none of the accepted ones might match
+                batch = [newFragment]
+                touched = set(index.matchingPrograms[batch[0]])
+                for score, fragment, _ in scoredFragments[1:]:
+                    if len(batch) >= fragmentsPerRound or score <= bestScore: break
+                    if touched & index.matchingPrograms[fragment]: continue
+                    batch.append(fragment)
+                    touched |= index.matchingPrograms[fragment]
+                if len(batch) > 1:
+                    # They still compete for probability mass, so check that they do better together
+                    batchScore, batchGrammar = grammarScore(FragmentGrammar.uniform(bestGrammar.primitives + batch))
+                    if batchScore > newScore:
+                        newScore, newGrammar = batchScore, batchGrammar
+                    else:
+                        eprint("%d fragments scored %f together, worse than the best of them alone"%
+                               (len(batch), batchScore))
+                        batch = batch[:1]
+
                 dS = newScore - bestScore
                 bestScore, bestGrammar = newScore, newGrammar
-                newPrimitiveLikelihood,newType,newPrimitive = bestGrammar.productions[-1]
-                expectedUses = bestGrammar.expectedUses(restrictedFrontiers).actualUses[newPrimitive]
-                eprint("New primitive of type %s\t%s\t\n(score = %f; dScore = %f; <uses> = %f)"%
-                       (newType,newPrimitive,newScore,dS,expectedUses))
+                accepted = bestGrammar.productions[-len(batch):]
+                for _,newType,newPrimitive in accepted:
+                    # Only the frontiers where the fragment might match can use it
+                    expectedUses = bestGrammar.expectedUses([ restrictedFrontiers[i]
+                                                              for i in sorted(index.frontiers(newPrimitive)) ])\
+                                              .actualUses[newPrimitive]
+                    eprint("New primitive of type %s\t%s\t\n(score = %f; dScore = %f; <uses> = %f)"%
+                           (newType,newPrimitive,newScore,dS,expectedUses))
                 
-                # Rewrite the frontiers in terms of the new fragment
-                concretePrimitive = defragment(newPrimitive)
-                bestGrammar.productions[-1] = (newPrimitiveLikelihood,
-                                               concretePrimitive.tp,
-                                               concretePrimitive)
-                frontiers = parallelMap(CPUs,
-                                        lambda frontier: bestGrammar.rescoreFrontier(RewriteFragments.rewriteFrontier(frontier, newPrimitive)),
-                                        frontiers)
-                eprint("\t(<uses> in rewritten frontiers: %f)"%
-                       (bestGrammar.expectedUses(frontiers).actualUses[concretePrimitive]))
+                # Rewrite the frontiers in terms of the new fragments
+                concretePrimitives = [ defragment(newPrimitive) for _,_,newPrimitive in accepted ]
+                bestGrammar = FragmentGrammar(bestGrammar.logVariable,
+                                              bestGrammar.productions[:-len(batch)] + \
+                                              [(newPrimitiveLikelihood,
+                                                concretePrimitive.tp,
+                                                concretePrimitive)
+                                               for (newPrimitiveLikelihood,_,_), concretePrimitive
+                                               in zip(accepted, concretePrimitives) ])
+                rewritten = [ [ any( index.mightMatch(newPrimitive, e.program) for e in frontier )
+                                for frontier in frontiers ]
+                              for newPrimitive in batch ]
+                def rewriteFrontier(frontier):
+                    for newPrimitive in batch:
+                        frontier = RewriteFragments.rewriteFrontier(frontier, newPrimitive, index)
+                    return bestGrammar.rescoreFrontier(frontier)
+                frontiers = parallelMap(CPUs, rewriteFrontier, frontiers)
+                for concretePrimitive, r in zip(concretePrimitives, rewritten):
+                    eprint("\t(<uses> of %s in rewritten frontiers: %f)"%
+                           (concretePrimitive,
+                            bestGrammar.expectedUses([ f for f,touched in zip(frontiers, r) if touched ])\
+                            .actualUses[concretePrimitive]))
+                inventions += len(batch)
+                rounds += 1
+                eprint("Round %d took %.1f sec"%(rounds, time.time() - roundStart))
+            if inventions > 0:
+                eprint("Invented %d primitives in %d rounds: %.1f sec per invention"%
+                       (inventions, rounds, (time.time() - induceStart)/inventions))
         else:
             eprint("Skipping fragment proposals")
 
@@ -388,7 +683,9 @@ def pypyInduce(*args, **kwargs):
 
 def rustInduce(g0, frontiers, _=None,
                topK=1, pseudoCounts=1.0, aic=1.0,
-               structurePenalty=0.001, a=0, CPUs=1):
+               structurePenalty=0.001, a=0, CPUs=1, fragmentsPerRound=1):
+    if fragmentsPerRound != 1:
+        eprint("The rust compressor adds one fragment per round, ignoring fragmentsPerRound =", fragmentsPerRound)
     import json
     import os
     import subprocess
@@ -2,7 +2,7 @@ from .type import *
 from .program import *
 from .frontier import *
 
-from collections import Counter
+from collections import Counter, defaultdict
 
 class MatchFailure(Exception): pass
 class Matcher(object):
@@ -177,9 +177,11 @@ class RewriteFragments(object):
     def rewrite(self,e): return e.visit(self,0)
 
     @staticmethod
-    def rewriteFrontier(frontier, fragment):
+    def rewriteFrontier(frontier, fragment, index=None):
         worker = RewriteFragments(fragment)
-        return Frontier([ FrontierEntry(program=worker.rewrite(e.program),
+        return Frontier([ FrontierEntry(program=worker.rewrite(e.program)
+                                        if index is None or index.mightMatch(fragment, e.program)
+                                        else e.program,
                                         logLikelihood=e.logLikelihood,
                                         logPrior=e.logPrior,
                                         logPosterior=e.logPosterior)
@@ -290,7 +292,48 @@ def proposeFragmentsFromProgram(p,arity):
 
     return { canonicalFragment(f) for b in range(arity + 1) for f in fragments(p,b) if nontrivial(f) }
 
-def proposeFragmentsFromFrontiers(frontiers, a, CPUs=1):
+class FragmentIndex(object):
+    """
+    Inverted index from fragments to where they might match in the programs
+    of some frontiers: fragment -> [(frontier index, program, position of
+    the subtree in program.walk())]. Matcher.match fails everywhere else.
+    """
+    def __init__(self, frontiers):
+        self.programs = set()
+        # Subtrees by the head of their application spine and its number of arguments
+        self.spines = defaultdict(list)
+        self.subtrees = []
+        for i, frontier in enumerate(frontiers):
+            for program in { e.program for e in frontier }:
+                self.programs.add(program)
+                for position, (_, e) in enumerate(program.walk()):
+                    site = (i, program, position, e)
+                    f, xs = e.applicationParse()
+                    if f.isPrimitive or f.isInvented: self.spines[(f, len(xs))].append(site)
+                    self.subtrees.append(site)
+        self.occurrences = {}
+        self.matchingPrograms = {}
+
+    def add(self, fragment):
+        f, xs = fragment.applicationParse()
+        if f.isPrimitive or f.isInvented: sites = self.spines.get((f, len(xs)), [])
+        else: sites = self.subtrees
+        self.occurrences[fragment] = [ (i, program, position)
+                                       for i, program, position, e in sites
+                                       if mightMatch(fragment, e) ]
+        self.matchingPrograms[fragment] = { program for _, program, _ in self.occurrences[fragment] }
+
+    def mightMatch(self, fragment, program):
+        """False only if fragment can't match anywhere in program"""
+        if fragment not in self.matchingPrograms or program not in self.programs: return True
+        return program in self.matchingPrograms[fragment]
+
+    def frontiers(self, fragment):
+        """Indices of the frontiers with a program that fragment might match"""
+        return { i for i, _, _ in self.occurrences[fragment] }
+
+def proposeFragmentsFromFrontiers(frontiers, a, CPUs=1, withIndex=False):
+    """Returns the fragments, and a FragmentIndex of them if withIndex"""
     fragmentsFromEachFrontier = parallelMap(CPUs, lambda frontier: \
                                             { fp
                                               for entry in frontier.entries
@@ -299,7 +342,12 @@ def proposeFragmentsFromFrontiers(frontiers, a, CPUs=1):
                                             frontiers)
     allFragments = Counter(f for frontierFragments in fragmentsFromEachFrontier
                            for f in frontierFragments)
-    return [ fragment for fragment, frequency in allFragments.items() 
-             if frequency >= 2 and fragment.wellTyped() and nontrivial(fragment) ]
+    fragments = [ fragment for fragment, frequency in allFragments.items()
+                  if frequency >= 2 and fragment.wellTyped() and nontrivial(fragment) ]
+    if not withIndex: return fragments
+
+    index = FragmentIndex(frontiers)
+    for fragment in fragments: index.add(fragment)
+    return fragments, index
 
 
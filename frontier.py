@@ -2,6 +2,7 @@ from .utilities import *
 from .task import Task
 
 class FrontierEntry(object):
+    __slots__ = ["program", "logPrior", "logLikelihood", "logPosterior"]
     def __init__(self, program, _=None, logPrior=None, logLikelihood=None, logPosterior=None):
         self.logPosterior = logPrior + logLikelihood if logPosterior is None else logPosterior
         self.program = program
@@ -9,6 +10,7 @@ class FrontierEntry(object):
         self.logLikelihood = logLikelihood
     def __repr__(self):
         return "FrontierEntry(program={self.program}, logPrior={self.logPrior}, logLikelihood={self.logLikelihood}".format(self=self)
+    def __setstate__(self, state): restoreSlots(self, state)
 
 
 class Frontier(object):
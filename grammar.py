@@ -12,6 +12,7 @@ import time
 class GrammarFailure(Exception): pass
 class NoCandidates(Exception): pass
 
+@sharedWithCompiledWorkers
 class Grammar(object):
     def __init__(self, logVariable, productions):
         self.logVariable = logVariable
@@ -20,6 +21,20 @@ class Grammar(object):
         self.expression2likelihood = dict( (p,l) for l,_,p in productions)
         self.expression2likelihood[Index(0)] = self.logVariable
 
+        self.productionIndex = ProductionIndex(productions)
+        # (canonical request & environment, mustBeLeaf) -> candidates
+        self.candidateCache = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["productionIndex"]
+        del state["candidateCache"]
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.productionIndex = ProductionIndex(self.productions)
+        self.candidateCache = {}
+
     @staticmethod
     def fromProductions(productions, logVariable=0.0):
         """Make a grammar from primitives and their relative logpriors."""
@@ -65,38 +80,78 @@ class Grammar(object):
         If returnTable is false (default): returns [((log)likelihood, tp, primitive, context)]
         if returntable is true: returns {primitive: ((log)likelihood, tp, context)}"""
         if returnProbabilities: assert normalize
-        
+
+        # The candidates only depend on the shape of the request and
+        # environment, so we look them up under their canonical types
+        # and then rename the canonical variables back into the caller's context
+        request = request.apply(context)
+        environment = [ t.apply(context) for t in environment ]
+        bindings = {}
+        key = (tuple( t.canonical(bindings) for t in [request] + environment ),
+               mustBeLeaf)
+        if key in self.candidateCache:
+            table, z = self.candidateCache[key]
+        else:
+            table, z = self._candidateTable(key[0][0], list(key[0][1:]), len(bindings), mustBeLeaf)
+            self.candidateCache[key] = (table, z)
+        if table == []: raise NoCandidates()
+        # canonical variable -> caller's variable
+        canonicalVariables = { c.v: TypeVariable(v) for v,c in bindings.items() }
+
+        candidates = []
+        for l,t,p,substitution in table:
+            if not t.isPolymorphic and substitution == []:
+                candidates.append((l,t,p,context))
+                continue
+            renaming = dict(canonicalVariables)
+            newContext, t = t.instantiate(context, renaming)
+            for v,b in substitution:
+                newContext, b = b.instantiate(newContext, renaming)
+                newContext = newContext.extend(renaming[v].v, b)
+            candidates.append((l,t,p,newContext))
+
+        if normalize:
+            if returnProbabilities: candidates = [ (exp(l - z), t, p, k) for l,t,p,k in candidates ]
+            else: candidates = [ (l - z, t, p, k) for l,t,p,k in candidates ]
+
+        if returnTable:
+            return {p: (l,t,k) for l,t,p,k in candidates }
+        else:
+            return candidates
+
+    def _candidateTable(self, request, environment, numberOfVariables, mustBeLeaf):
+        """Unnormalized candidates for a canonical request and environment,
+        whose type variables are 0 .. numberOfVariables - 1.
+        Returns ([(loglikelihood, tp, primitive, substitution)], normalizer),
+        where substitution lists the bindings [(variable, tp)] made to the canonical variables."""
+        context = Context(numberOfVariables)
+        def substitution(newContext):
+            return [ (v, TypeVariable(v).apply(newContext))
+                     for v in range(numberOfVariables)
+                     if v in newContext.substitution ]
+
         candidates = []
         variableCandidates = []
-        for l,t,p in self.productions:
+        for l,t,p in self.productionIndex.lookup(request):
             try:
                 newContext, t = t.instantiate(context)
                 newContext = newContext.unify(t.returns(), request)
                 t = t.apply(newContext)
                 if mustBeLeaf and t.isArrow(): continue
-                candidates.append((l,t,p,newContext))
+                candidates.append((l,t,p,substitution(newContext)))
             except UnificationFailure: continue
         for j,t in enumerate(environment):
             try:
                 newContext = context.unify(t.returns(), request)
                 t = t.apply(newContext)
                 if mustBeLeaf and t.isArrow(): continue
-                variableCandidates.append((t, Index(j), newContext))
+                variableCandidates.append((t, Index(j), substitution(newContext)))
             except UnificationFailure: continue
 
         candidates += [ (self.logVariable - log(len(variableCandidates)), t, p, k)
                         for t,p,k in variableCandidates ]
-        if candidates == []: raise NoCandidates()
-        
-        if normalize:
-            z = lse([ l for l,t,p,k in candidates ])
-            if returnProbabilities: candidates = [ (exp(l - z), t, p, k) for l,t,p,k in candidates ]
-            else: candidates = [ (l - z, t, p, k) for l,t,p,k in candidates ]
-
-        if returnTable:
-            return {p: (l,t,k) for l,t,p,k in candidates }
-        else:
-            return candidates
+        if candidates == []: return [], None
+        return candidates, lse([ l for l,t,p,k in candidates ])
 
     def sample(self, request, maximumDepth=3):
         while True:
@@ -191,68 +246,104 @@ class Grammar(object):
 
         return context, thisSummary
 
-    def bestFirstEnumeration(self, request):
+    def bestFirstEnumeration(self, request, _=None,
+                             lowerBound=0., upperBound=POSITIVEINFINITY,
+                             maximumQueueSize=10**6, spillIncrement=1.):
+        '''Enumerates programs whose MDL satisfies lowerBound < MDL <= upperBound,
+        in order of increasing MDL (decreasing prior). Yields (log prior, context, program).
+        Partial programs wait in a priority queue; if it grows past
+        maximumQueueSize we give up on exact ordering and fall back on
+        iterative deepening, in windows of spillIncrement nats,
+        starting from the last MDL that we yielded.'''
         from heapq import heappush, heappop
-        
-        pq = []
 
-        def choices(parentCost, xs):
-            for c,x in xs: heappush(pq, (parentCost+c,x))
+        # A partial program is a stack of holes still to be filled, and
+        # the preorder sequence of what we have filled in so far. Both are
+        # linked lists of pairs, so that partial programs can share structure.
+        # A hole is (request, environment, function, argument index); the
+        # function and argument index are used for symmetry breaking.
+        # A filled in hole is either LAMBDA or (production, number of arguments)
+        LAMBDA = None
+        def build(actions):
+            preorder = []
+            while actions is not None:
+                action, actions = actions
+                preorder.append(action)
+            preorder.reverse()
+            def parse(j):
+                if preorder[j] is LAMBDA:
+                    body, j = parse(j + 1)
+                    return Abstraction(body), j
+                f, numberOfArguments = preorder[j]
+                j += 1
+                for _ in range(numberOfArguments):
+                    x, j = parse(j)
+                    f = Application(f, x)
+                return f, j
+            return parse(0)[0]
 
-        def g(parentCost, request, _=None,
-              context=None, environment=[],
-              k=None):
-            """
-            k is a continuation. 
-            k: Expects to be called with MDL, context, expression.
-            """
-            
-            assert k is not None
-            if context is None: context = Context.EMPTY
-
-            if request.isArrow():
-                g(parentCost, request.arguments[1],
-                  context = context,
-                  environment = [request.arguments[0]] + environment,
-                  k = lambda MDL, newContext, p: k(MDL, newContext, Abstraction(p)))
-            else:            
-                candidates = self.buildCandidates(request, context, environment,
-                                                  normalize=True,
-                                                  returnProbabilities=False,
-                                                  returnTable=True)
-                choices(parentCost,
-                        [(-f_ll_tp_newContext[1][0],
-                             lambda: ga(parentCost-f_ll_tp_newContext[1][0], f_ll_tp_newContext[0], f_ll_tp_newContext[1][1].functionArguments(),
-                                        context=f_ll_tp_newContext[1][2], environment=environment,
-                                        k=k)) for f_ll_tp_newContext in iter(candidates.items())])
-        def ga(costSoFar, f, argumentTypes, _=None,
-               context=None, environment=None,
-               k=None):
-            if argumentTypes == []:
-                k(costSoFar, context, f)
-            else:
-                t1 = argumentTypes[0].apply(context)
-                g(costSoFar, t1, context=context, environment=environment,
-                  k=lambda newCost, newContext, argument: \
-                  ga(newCost, Application(f,argument), argumentTypes[1:],
-                     context=newContext, environment=environment,
-                     k=k))
-
-        def receiveResult(MDL, _, expression):
-            heappush(pq, (MDL, expression))
-
-
-        g(0., request, context=Context.EMPTY, environment=[], k=receiveResult)
-        frontier = []
-        while len(frontier) < 10**3:
-            MDL, action = heappop(pq)
-            if isinstance(action, Program):
-                expression = action
-                frontier.append(expression)
-                #eprint("Enumerated program",expression,-MDL,self.closedLogLikelihood(request, expression))
-            else:
-                action()
+        pq = []
+        # Breaks ties between partial programs of equal cost, first come first serve
+        timestamp = 0
+        heappush(pq, (0., timestamp, Context.EMPTY, ((request, [], None, None), None), None))
+
+        lastMDL = lowerBound
+        # Programs yielded with MDL (approximately) lastMDL, which the
+        # iterative deepening fallback would otherwise yield a second time
+        yieldedAtLastMDL = set()
+        while pq:
+            if len(pq) > maximumQueueSize:
+                eprint("bestFirstEnumeration: queue exceeded %d partial programs, falling back on iterative deepening at MDL %f"%
+                       (maximumQueueSize, lastMDL))
+                pq = None
+                budget = lastMDL - 1e-6
+                while budget < upperBound:
+                    for l, context, p in self.enumeration(Context.EMPTY, [], request,
+                                                          maximumDepth=99,
+                                                          lowerBound=budget,
+                                                          upperBound=min(budget + spillIncrement, upperBound)):
+                        if -l <= lowerBound or p in yieldedAtLastMDL: continue
+                        yield l, context, p
+                    budget += spillIncrement
+                return
+
+            cost, _, context, holes, actions = heappop(pq)
+            if holes is None:
+                if cost <= lowerBound: continue
+                p = build(actions)
+                if cost > lastMDL + 1e-6:
+                    yieldedAtLastMDL = set()
+                    lastMDL = cost
+                yieldedAtLastMDL.add(p)
+                yield -cost, context, p
+                continue
+
+            (holeRequest, environment, function, argumentIndex), holes = holes
+            holeRequest = holeRequest.apply(context)
+            if holeRequest.isArrow():
+                timestamp += 1
+                heappush(pq, (cost, timestamp, context,
+                              ((holeRequest.arguments[1], [holeRequest.arguments[0]] + environment, None, None),
+                               holes),
+                              (LAMBDA, actions)))
+                continue
 
+            try:
+                candidates = self.buildCandidates(holeRequest, context, environment,
+                                                  normalize=True)
+            except NoCandidates: continue
+            for l, t, p, newContext in candidates:
+                newCost = cost - l
+                if newCost > upperBound: continue
+                if function is not None and violatesSymmetry(function, p, argumentIndex): continue
+
+                xs = t.functionArguments()
+                newHoles = holes
+                for j in reversed(range(len(xs))):
+                    newHoles = ((xs[j], environment, p, j), newHoles)
+                timestamp += 1
+                heappush(pq, (newCost, timestamp, newContext, newHoles,
+                              ((p, len(xs)), actions)))
 
     def closedLikelihoodSummary(self, request, expression, silent=False):
         try:
@@ -302,8 +393,11 @@ class Grammar(object):
                        [(-log(frequencies[len(t.functionArguments())]) - len(t.functionArguments())*expectedSize,
                          t,p) for l,t,p in self.productions ])
 
-    def enumeration(self, context, environment, request, upperBound, maximumDepth=20, lowerBound=0.):
-        '''Enumerates all programs whose MDL satisfies: lowerBound < MDL <= upperBound'''
+    def enumeration(self, context, environment, request, upperBound, maximumDepth=20, lowerBound=0.,
+                    observationalEquivalence=None):
+        '''Enumerates all programs whose MDL satisfies: lowerBound < MDL <= upperBound
+        observationalEquivalence: optional, decides which arguments are redundant
+        (see enumeration.ObservationalEquivalence)'''
         if upperBound <= 0 or maximumDepth == 1: return 
 
         if request.isArrow():
@@ -312,7 +406,8 @@ class Grammar(object):
                                                      request.arguments[1],
                                                      upperBound=upperBound,
                                                      lowerBound=lowerBound,
-                                                     maximumDepth=maximumDepth):
+                                                     maximumDepth=maximumDepth,
+                                                     observationalEquivalence=observationalEquivalence):
                 yield l, newContext, Abstraction(b)
 
         else:
@@ -328,7 +423,8 @@ class Grammar(object):
                     self.enumerateApplication(newContext, environment, p, xs,
                                               upperBound=upperBound + l,
                                               lowerBound=lowerBound + l,
-                                              maximumDepth=maximumDepth - 1):
+                                              maximumDepth=maximumDepth - 1,
+                                              observationalEquivalence=observationalEquivalence):
                     yield aL+l, aK, application
 
     def enumerateApplication(self, context, environment,
@@ -339,7 +435,8 @@ class Grammar(object):
                              lowerBound=0.,
                              maximumDepth=20,
                              originalFunction=None,
-                             argumentIndex=0):
+                             argumentIndex=0,
+                             observationalEquivalence=None):
         if upperBound <= 0 or maximumDepth == 1: return
         if originalFunction is None: originalFunction = function
 
@@ -353,8 +450,12 @@ class Grammar(object):
             for argL, newContext, arg in self.enumeration(context, environment, argRequest,
                                                           upperBound=upperBound,
                                                           lowerBound=0.,
-                                                          maximumDepth=maximumDepth):
+                                                          maximumDepth=maximumDepth,
+                                                          observationalEquivalence=observationalEquivalence):
                 if violatesSymmetry(originalFunction, arg, argumentIndex): continue
+                if observationalEquivalence is not None and \
+                   observationalEquivalence.redundant(argRequest.apply(newContext), environment, arg, -argL):
+                    continue
                 
                 newFunction = Application(function, arg)
                 for resultL, resultK, result in self.enumerateApplication(newContext, environment, newFunction,
@@ -363,7 +464,8 @@ class Grammar(object):
                                                                           lowerBound=lowerBound + argL,
                                                                           maximumDepth=maximumDepth,
                                                                           originalFunction=originalFunction,
-                                                                          argumentIndex=argumentIndex+1):
+                                                                          argumentIndex=argumentIndex+1,
+                                                                          observationalEquivalence=observationalEquivalence):
                     yield resultL + argL, resultK, result
 
     def enumerateNearby(self, request, expr, distance=3.0):
@@ -485,6 +587,24 @@ class Uses(object):
     
 Uses.empty = Uses()
 
+class ProductionIndex(object):
+    '''Indexes productions by the constructor of their return type.
+    Productions returning a type variable could return anything and are included under every constructor.'''
+    def __init__(self, productions):
+        self.productions = productions
+        self.wildcard = [ (l,t,p) for l,t,p in productions
+                          if isinstance(t.returns(), TypeVariable) ]
+        heads = { t.returns().name for l,t,p in productions
+                  if not isinstance(t.returns(), TypeVariable) }
+        # Keep the productions in their original order so that candidates are too
+        self.byHead = { h: [ (l,t,p) for l,t,p in productions
+                             if isinstance(t.returns(), TypeVariable) or t.returns().name == h ]
+                        for h in heads }
+    def lookup(self, request):
+        """Productions whose return type might unify with the (already applied) request"""
+        if isinstance(request, TypeVariable): return self.productions
+        return self.byHead.get(request.name, self.wildcard)
+
 def violatesSymmetry(f,x,argumentIndex):
     if not f.isPrimitive: return False
     while x.isApplication: x = x.f
@@ -1,4 +1,4 @@
-from .utilities import eprint, exp, log, timing, valid
+from .utilities import eprint, exp, log, timing, valid, NEGATIVEINFINITY
 from .task import Task
 import random
 import gc
@@ -12,6 +12,13 @@ class AllOrNothingLikelihoodModel:
         logLikelihood = task.logLikelihood(program, self.timeout)
         return valid(logLikelihood), logLikelihood
 
+    def scoreMany(self, programs, task):
+        """Same as [self.score(p, task) for p in programs], but shares work between the programs"""
+        if type(task).logLikelihood is not Task.logLikelihood:
+            return [ self.score(p, task) for p in programs ]
+        return [ (success, 0.0 if success else NEGATIVEINFINITY)
+                 for success in task.checkMany(programs, self.timeout) ]
+
 
 class EuclideanLikelihoodModel:
     """Likelihood is based on Euclidean distance between features"""
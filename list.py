@@ -116,7 +116,7 @@ def isIntFunction(tp):
 class FeatureExtractor(HandCodedFeatureExtractor):
     N_EXAMPLES = 15
     def _featuresOfProgram(self, program, tp):
-        e = program.evaluate([])
+        e = program.compile()([])
         examples = []
         if isListFunction(tp):
             sample = lambda: random.sample(range(30), random.randint(0, 8))
@@ -141,7 +141,7 @@ class DeepFeatureExtractor(MLPFeatureExtractor):
     def __init__(self, tasks):
         super(DeepFeatureExtractor, self).__init__(tasks, cuda=self.USE_CUDA, H=self.H)
     def _featuresOfProgram(self, program, tp):
-        e = program.evaluate([])
+        e = program.compile()([])
         examples = []
         if isListFunction(tp):
             sample = lambda: random.sample(range(30), random.randint(0, 8))
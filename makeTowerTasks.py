@@ -65,22 +65,15 @@ class TowerTask(Task):
         return Bunch(result) if result is not None else result
 
     def logLikelihood(self, e, timeout=None):
-        if timeout is not None:
-            def timeoutCallBack(_1,_2): raise EvaluationTimeout()
-            signal.signal(signal.SIGVTALRM, timeoutCallBack)
-            signal.setitimer(signal.ITIMER_VIRTUAL, timeout)
-            
+        if timeout is not None and EVALUATIONTIMER.timeout is None:
+            with EVALUATIONTIMER.armed(timeout): return self.logLikelihood(e, timeout)
+
         try:
-            tower = e.evaluate([])
-            if timeout is not None:
-                signal.signal(signal.SIGVTALRM, lambda *_:None)
-                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
-        except EvaluationTimeout: return NEGATIVEINFINITY
-        except:
-            if timeout is not None:
-                signal.signal(signal.SIGVTALRM, lambda *_:None)
-                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
-            return NEGATIVEINFINITY
+            if timeout is not None: EVALUATIONTIMER.begin()
+            tower = e.compile()([])
+        except: return NEGATIVEINFINITY
+        finally:
+            if timeout is not None: EVALUATIONTIMER.end()
 
         
         mass = sum(w*h for _,w,h in tower)
@@ -5,14 +5,57 @@ from .utilities import *
 
 from time import time
 import math
+import re
+import weakref
 
 
 class InferenceFailure(Exception): pass
 class ShiftFailure(Exception): pass
 class ParseFailure(Exception): pass
 
+class HashConsTable(object):
+    """
+    Weak valued dictionary from the children of a program node to the node,
+    like weakref.WeakValueDictionary but cheaper to query and update.
+    An entry lives exactly as long as its node, which keeps its children
+    (and so their identities) alive.
+    """
+    class Reference(weakref.ref):
+        __slots__ = ["key"]
+
+    def __init__(self):
+        self.table = {}
+        table = self.table
+        def remove(r):
+            if table.get(r.key) is r: del table[r.key]
+        self.remove = remove
+    def __len__(self): return len(self.table)
+    def get(self, key):
+        r = self.table.get(key)
+        return r() if r is not None else None
+    def add(self, key, value):
+        r = HashConsTable.Reference(value, self.remove)
+        r.key = key
+        self.table[key] = r
+
+
 class Program(object):
+    """
+    Programs are hash consed: constructing an Application, Abstraction,
+    Index, Invented, or Primitive returns the existing node with the same
+    children if there is one, so structurally equal programs are
+    usually (but not always, eg programs unpickled from old checkpoints)
+    the same object. Nodes are never mutated after construction.
+    """
+    # Slots, rather than a __dict__ per node, because enumeration
+    # allocates millions of nodes. Subclasses list their own fields.
+    __slots__ = ["compiledProgram", "__weakref__"]
     def __repr__(self): return str(self)
+    def __setstate__(self, state):
+        # Checkpoints from before hash consing. Nodes with a hash code
+        # compute it again from their children, which are restored first:
+        # the one in the checkpoint (if any) was salted by another process
+        restoreSlots(self, state)
     def __ne__(self,o): return not (self == o)
     def __str__(self): return self.show(False)
     def canHaveType(self, t):
@@ -59,9 +102,23 @@ class Program(object):
         except InferenceFailure:
             return False
     def runWithArguments(self, xs):
-        f = self.evaluate([])
+        f = self.compile()([])
         for x in xs: f = f(x)
         return f
+    def compile(self):
+        """Returns a function from an environment to the value of this program.
+        Equivalent to self.evaluate, but the tree is only walked once:
+        the result is a tree of closures, which is cached on the program."""
+        try: return self.compiledProgram
+        except AttributeError:
+            self.compiledProgram = self._compile()
+            return self.compiledProgram
+    def _compile(self): return self.evaluate
+    def evaluateWithMemo(self, environment, memo):
+        """Like evaluate, but shares the values of applications through memo,
+        a dictionary from program to value. Everything evaluated with the
+        same memo has to be evaluated in the same environment."""
+        return self.compile()(environment)
     def applicationParses(self): yield self,[]
     def applicationParse(self): return self,[]
     @property
@@ -97,23 +154,72 @@ class Program(object):
 
     @staticmethod
     def parse(s):
-        e,s = Program._parse(s.strip())
-        if s != "": raise ParseFailure(s)
-        return e
-    @staticmethod
-    def _parse(s):
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-        for p in [Application, Abstraction, Index, Invented, FragmentVariable, Primitive]:
-            try: return p._parse(s)
-            except ParseFailure: continue
+        """
+        Parses the output of show, in a single pass over the tokens of s.
+        Lambdas can also be written as (\\ body) or (\u03bb body).
+        """
+        # Each frame is a list of the expressions parsed so far inside of an
+        # open parenthesis (application or lambda) or after a #
+        stack = []
+        tokens = PROGRAMTOKENS.findall(s)
+        for j, token in enumerate(tokens):
+            if token == '(':
+                stack.append(['('])
+                continue
+            if token == '#':
+                stack.append(['#'])
+                continue
+            if token == ')':
+                if not stack or stack[-1][0] == '#': raise ParseFailure(s)
+                frame = stack.pop()
+                if frame[0] == 'lambda':
+                    if len(frame) != 2: raise ParseFailure(s)
+                    e = Abstraction(frame[1])
+                else:
+                    if len(frame) == 1: raise ParseFailure(s)
+                    e = frame[1]
+                    for x in frame[2:]: e = Application(e,x)
+            elif token in LAMBDATOKENS and len(stack) > 0 and stack[-1] == ['(']:
+                stack[-1][0] = 'lambda'
+                continue
+            elif token[0] == '?': e = FragmentVariable.single
+            elif token[0] == '$' and token[1:].isdigit(): e = Index(int(token[1:]))
+            else:
+                e = Primitive.GLOBALS.get(token, None)
+                if e is None: raise ParseFailure(s)
+
+            # e is a complete expression
+            while len(stack) > 0 and stack[-1][0] == '#':
+                stack.pop()
+                e = Invented(e)
+            if len(stack) == 0:
+                if j != len(tokens) - 1: raise ParseFailure(s)
+                return e
+            stack[-1].append(e)
         raise ParseFailure(s)
 
+# Parentheses, invented primitive markers, fragment variables, indices,
+# lambdas (which need not be followed by a space before their body),
+# and otherwise anything up to the next space or parenthesis
+PROGRAMTOKENS = re.compile(r'\s*(\(|\)|#|\?\??|\$\d+|\\|\u03bb|lambda(?=[$#?])|[^\s()]+)')
+LAMBDATOKENS = {'lambda', '\\', '\u03bb'}
+
 class Application(Program):
     '''Function application'''
-    def __init__(self,f,x):
+    __slots__ = ["f", "x", "hashCode", "isConditional", "branch", "trueBranch", "falseBranch"]
+    # Children are hash consed, so their identities determine the application
+    TABLE = HashConsTable()
+    def __new__(cls, f=None, x=None):
+        # No arguments: unpickling a checkpoint from before hash consing
+        if f is None: return super(Application, cls).__new__(cls)
+        key = (id(f), id(x))
+        self = Application.TABLE.get(key)
+        if self is not None: return self
+
+        self = super(Application, cls).__new__(cls)
         self.f = f
         self.x = x
-        self.hashCode = None
+        self.hashCode = hash((hash(f), hash(x)))
         self.isConditional = f.isApplication and \
                              f.f.isApplication and \
                              f.f.f.isPrimitive and \
@@ -122,14 +228,20 @@ class Application(Program):
             self.falseBranch = x
             self.trueBranch = f.x
             self.branch = f.f.x
-            
+        Application.TABLE.add(key, self)
+        return self
+    def __reduce__(self): return (Application, (self.f, self.x))
+    def __setstate__(self, state):
+        Program.__setstate__(self, state)
+        self.hashCode = hash((hash(self.f), hash(self.x)))
+
     @property
     def isApplication(self): return True
-    def __eq__(self,other): return isinstance(other,Application) and self.f == other.f and self.x == other.x
-    def __hash__(self):
-        if self.hashCode == None:
-            self.hashCode = hash((hash(self.f), hash(self.x)))
-        return self.hashCode
+    def __eq__(self,other):
+        return self is other or \
+            (isinstance(other,Application) and self.hashCode == other.hashCode and \
+             self.f == other.f and self.x == other.x)
+    def __hash__(self): return self.hashCode
     def visit(self, visitor, *arguments, **keywords): return visitor.application(self, *arguments, **keywords)
     def show(self, isFunction):
         if isFunction: return "%s %s"%(self.f.show(True), self.x.show(False))
@@ -142,6 +254,36 @@ class Application(Program):
                 return self.falseBranch.evaluate(environment)
         else:
             return self.f.evaluate(environment)(self.x.evaluate(environment))
+    def _compile(self):
+        if self.isConditional:
+            branch = self.branch.compile()
+            trueBranch = self.trueBranch.compile()
+            falseBranch = self.falseBranch.compile()
+            return lambda environment: trueBranch(environment) if branch(environment) \
+                else falseBranch(environment)
+        # Specialize the common cases of applying a primitive or applying to a variable
+        if self.f.isPrimitive:
+            f = self.f.value
+            x = self.x.compile()
+            return lambda environment: f(x(environment))
+        f = self.f.compile()
+        if self.x.isIndex:
+            i = self.x.i
+            return lambda environment: f(environment)(environment[i])
+        x = self.x.compile()
+        return lambda environment: f(environment)(x(environment))
+    def evaluateWithMemo(self, environment, memo):
+        if self in memo: return memo[self]
+        # Exceptions are not remembered: they might be timeouts
+        if self.isConditional:
+            if self.branch.evaluateWithMemo(environment, memo):
+                value = self.trueBranch.evaluateWithMemo(environment, memo)
+            else:
+                value = self.falseBranch.evaluateWithMemo(environment, memo)
+        else:
+            value = self.f.evaluateWithMemo(environment, memo)(self.x.evaluateWithMemo(environment, memo))
+        memo[self] = value
+        return value
     def inferType(self,context,environment,freeVariables):
         (context,ft) = self.f.inferType(context,environment,freeVariables)
         (context,xt) = self.x.inferType(context,environment,freeVariables)
@@ -178,40 +320,32 @@ class Application(Program):
 
     def size(self): return self.f.size() + self.x.size()
 
-    @staticmethod
-    def _parse(s):
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-        if s == "" or s[0] != '(': raise ParseFailure(s)
-        s = s[1:]
-
-        xs = []
-        while True:
-            x,s = Program._parse(s)
-            xs.append(x)
-            while len(s) > 0 and s[0].isspace(): s = s[1:]
-            if s == "": raise ParseFailure(s)
-            if s[0] == ")":
-                s = s[1:]
-                break
-        e = xs[0]
-        for x in xs[1:]: e = Application(e,x)
-        return e,s
-
-            
-
 class Index(Program):
     '''
     deBruijn index: https://en.wikipedia.org/wiki/De_Bruijn_index
     These indices encode variables.
     '''
-    def __init__(self,i):
+    __slots__ = ["i"]
+    TABLE = HashConsTable()
+    def __new__(cls, i=None):
+        if i is None: return super(Index, cls).__new__(cls)
+        self = Index.TABLE.get(i)
+        if self is not None: return self
+
+        self = super(Index, cls).__new__(cls)
         self.i = i
+        Index.TABLE.add(i, self)
+        return self
+    def __reduce__(self): return (Index, (self.i,))
     def show(self,isFunction): return "$%d"%self.i
-    def __eq__(self,o): return isinstance(o,Index) and o.i == self.i
+    def __eq__(self,o): return self is o or (isinstance(o,Index) and o.i == self.i)
     def __hash__(self): return self.i
     def visit(self, visitor, *arguments, **keywords): return visitor.index(self, *arguments, **keywords)
     def evaluate(self,environment):
         return environment[self.i]
+    def _compile(self):
+        i = self.i
+        return lambda environment: environment[i]
     def inferType(self,context,environment,freeVariables):
         if self.bound(len(environment)):
             return (context, environment[self.i].apply(context))
@@ -249,36 +383,40 @@ class Index(Program):
     @property
     def isIndex(self): return True
 
-    @staticmethod
-    def _parse(s):
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-        if s == "" or s[0] != '$': raise ParseFailure(s)
-        s = s[1:]
-        n = ""
-        while s != "" and s[0].isdigit():
-            n += s[0]
-            s = s[1:]
-        if n == "": raise ParseFailure(s)
-        return Index(int(n)),s
-        
 
 
 class Abstraction(Program):
     '''Lambda abstraction. Creates a new function.'''
-    def __init__(self,body):
+    __slots__ = ["body", "hashCode"]
+    TABLE = HashConsTable()
+    def __new__(cls, body=None):
+        if body is None: return super(Abstraction, cls).__new__(cls)
+        self = Abstraction.TABLE.get(id(body))
+        if self is not None: return self
+
+        self = super(Abstraction, cls).__new__(cls)
         self.body = body
-        self.hashCode = None
+        self.hashCode = hash((hash(body),))
+        Abstraction.TABLE.add(id(body), self)
+        return self
+    def __reduce__(self): return (Abstraction, (self.body,))
+    def __setstate__(self, state):
+        Program.__setstate__(self, state)
+        self.hashCode = hash((hash(self.body),))
     @property
     def isAbstraction(self): return True
-    def __eq__(self,o): return isinstance(o,Abstraction) and o.body == self.body
-    def __hash__(self):
-        if self.hashCode == None: self.hashCode = hash((hash(self.body),))
-        return self.hashCode
+    def __eq__(self,o):
+        return self is o or \
+            (isinstance(o,Abstraction) and self.hashCode == o.hashCode and o.body == self.body)
+    def __hash__(self): return self.hashCode
     def visit(self, visitor, *arguments, **keywords): return visitor.abstraction(self, *arguments, **keywords)
     def show(self,isFunction):
         return "(lambda %s)"%(self.body.show(False))
     def evaluate(self,environment):
         return lambda x: self.body.evaluate([x] + environment)
+    def _compile(self):
+        body = self.body.compile()
+        return lambda environment: lambda x: body([x] + environment)
     def inferType(self,context,environment,freeVariables):
         (context,argumentType) = context.makeVariable()
         (context,returnType) = self.body.inferType(context,[argumentType] + environment,freeVariables)
@@ -301,40 +439,39 @@ class Abstraction(Program):
 
     def size(self): return self.body.size()
 
-    @staticmethod
-    def _parse(s):
-        if s.startswith('(\\'):
-            s = s[2:]
-        elif s.startswith('(lambda'):
-            s = s[len('(lambda'):]
-        elif s.startswith('(\u03bb'):
-            s = s[len('(\u03bb'):]
-        else: raise ParseFailure(s)
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-
-        b,s = Program._parse(s)
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-        if s == "" or s[0] != ')': raise ParseFailure(s)
-        s = s[1:]
-        return Abstraction(b),s
-
-
-        
-
 class Primitive(Program):
+    __slots__ = ["name", "tp", "value"]
     GLOBALS = {}
-    def __init__(self, name, ty, value):
+    # Keyed by name and value, rather than just name, because some
+    # primitives are instantiated many times with different values (eg REAL)
+    TABLE = HashConsTable()
+    def __new__(cls, name=None, ty=None, value=None):
+        if name is None: return super(Primitive, cls).__new__(cls)
+        key = (name, id(value))
+        self = Primitive.TABLE.get(key)
+        if self is not None and self.tp == ty: return self
+
+        self = super(Primitive, cls).__new__(cls)
         self.tp = ty
         self.name = name
         self.value = value
         if name not in Primitive.GLOBALS: Primitive.GLOBALS[name] = self
+        Primitive.TABLE.add(key, self)
+        return self
+    def __reduce__(self):
+        if Primitive.GLOBALS.get(self.name) is self:
+            return (_unpicklePrimitive, (self.name, self.tp, self.value))
+        return (Primitive, (self.name, self.tp, self.value))
     @property
     def isPrimitive(self): return True
-    def __eq__(self,o): return isinstance(o,Primitive) and o.name == self.name
+    def __eq__(self,o): return self is o or (isinstance(o,Primitive) and o.name == self.name)
     def __hash__(self): return hash(self.name)
     def visit(self, visitor, *arguments, **keywords): return visitor.primitive(self, *arguments, **keywords)
     def show(self,isFunction): return self.name
     def evaluate(self,environment): return self.value
+    def _compile(self):
+        value = self.value
+        return lambda environment: value
     def inferType(self,context,environment,freeVariables):
         return self.tp.instantiate(context)
     def shift(self,offset, depth=0): return self
@@ -347,34 +484,47 @@ class Primitive(Program):
 
     def size(self): return 1
 
-    @staticmethod
-    def _parse(s):
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-        name = ""
-        while s != "" and not s[0].isspace() and s[0] not in '()':
-            name += s[0]
-            s = s[1:]
-        if name in Primitive.GLOBALS:
-            return Primitive.GLOBALS[name],s
-        raise ParseFailure(s)
 
 
+def _unpicklePrimitive(name, ty, value):
+    # Values are often rebuilt by unpickling (eg lists), so prefer this
+    # process's primitive with the same name over a new copy
+    p = Primitive.GLOBALS.get(name)
+    if p is not None and p.tp == ty: return p
+    return Primitive(name, ty, value)
+
 
 class Invented(Program):
     '''New invented primitives'''
-    def __init__(self, body):
+    __slots__ = ["body", "tp", "hashCode"]
+    TABLE = HashConsTable()
+    def __new__(cls, body=None):
+        if body is None: return super(Invented, cls).__new__(cls)
+        self = Invented.TABLE.get(id(body))
+        if self is not None: return self
+
+        self = super(Invented, cls).__new__(cls)
         self.body = body
-        self.tp = self.body.infer()
-        self.hashCode = None
+        self.tp = body.infer()
+        self.hashCode = hash((0,hash(body)))
+        Invented.TABLE.add(id(body), self)
+        return self
+    def __reduce__(self): return (Invented, (self.body,))
+    def __setstate__(self, state):
+        Program.__setstate__(self, state)
+        self.hashCode = hash((0,hash(self.body)))
     @property
     def isInvented(self): return True
     def show(self,isFunction): return "#%s"%(self.body.show(False))
     def visit(self, visitor, *arguments, **keywords): return visitor.invented(self, *arguments, **keywords)
-    def __eq__(self,o): return isinstance(o,Invented) and o.body == self.body
-    def __hash__(self):
-        if self.hashCode == None: self.hashCode = hash((0,hash(self.body)))
-        return self.hashCode
+    def __eq__(self,o):
+        return self is o or \
+            (isinstance(o,Invented) and self.hashCode == o.hashCode and o.body == self.body)
+    def __hash__(self): return self.hashCode
     def evaluate(self,e): return self.body.evaluate([])
+    def _compile(self):
+        body = self.body.compile()
+        return lambda environment: body([])
     def inferType(self,context,environment,freeVariables):
         return self.tp.instantiate(context)
     def shift(self,offset, depth=0): return self
@@ -387,16 +537,8 @@ class Invented(Program):
 
     def size(self): return 1
 
-    @staticmethod
-    def _parse(s):
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-        if not s.startswith('#'): raise ParseFailure(s)
-        s = s[1:]
-        b,s = Program._parse(s)
-        return Invented(b),s
-    
-
 class FragmentVariable(Program):
+    __slots__ = []
     def __init__(self): pass
     def show(self,isFunction): return "??"
     def __eq__(self,o): return isinstance(o,FragmentVariable)
@@ -425,55 +567,19 @@ class FragmentVariable(Program):
 
     def size(self): return 1
 
-    @staticmethod
-    def _parse(s):
-        while len(s) > 0 and s[0].isspace(): s = s[1:]
-        if s.startswith('??'): return FragmentVariable.single, s[2:]
-        if s.startswith('?'): return FragmentVariable.single, s[1:]
-        raise ParseFailure(s)
 
 FragmentVariable.single = FragmentVariable()
 
 class ShareVisitor(object):
-    def __init__(self):
-        self.primitiveTable = {}
-        self.inventedTable = {}
-        self.indexTable = {}
-        self.applicationTable = {}
-        self.abstractionTable = {}
-        
-    def invented(self,e):
-        body = e.body.visit(self)
-        i = id(body)
-        if i in self.inventedTable: return self.inventedTable[i]
-        new = Invented(body)
-        self.inventedTable[i] = new
-        return new
-    def primitive(self,e):
-        if e.name in self.primitiveTable: return self.primitiveTable[e.name]
-        self.primitiveTable[e.name] = e
-        return e
-    def index(self,e):
-        if e.i in self.indexTable: return self.indexTable[e.i]
-        self.indexTable[e.i] = e
-        return e
-    def application(self,e):
-        f = e.f.visit(self)
-        x = e.x.visit(self)
-        fi = id(f)
-        xi = id(x)
-        i = (fi,xi)
-        if i in self.applicationTable: return self.applicationTable[i]
-        new = Application(f,x)
-        self.applicationTable[i] = new
-        return new        
-    def abstraction(self,e):
-        body = e.body.visit(self)
-        i = id(body)
-        if i in self.abstractionTable: return self.abstractionTable[i]
-        new = Abstraction(body)
-        self.abstractionTable[i] = new
-        return new
+    """Rebuilds a program bottom up, so that it is hash consed.
+    Only needed for programs which bypassed the constructors,
+    eg those unpickled from checkpoints made before hash consing."""
+    def invented(self,e): return Invented(e.body.visit(self))
+    def primitive(self,e): return _unpicklePrimitive(e.name, e.tp, e.value)
+    def index(self,e): return Index(e.i)
+    def application(self,e): return Application(e.f.visit(self), e.x.visit(self))
+    def abstraction(self,e): return Abstraction(e.body.visit(self))
+    def fragmentVariable(self,e): return e
     def execute(self,e):
         return e.visit(self)
 
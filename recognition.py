@@ -478,7 +478,8 @@ class RecognitionModel(nn.Module):
     def enumerateFrontiers(self, tasks, likelihoodModel,
                            solver=None,
                            frontierSize=None, enumerationTimeout=None,
-                           CPUs=1, maximumFrontier=None, evaluationTimeout=None):
+                           CPUs=1, maximumFrontier=None, evaluationTimeout=None,
+                           budgetScheduler=None, observationalEquivalence=False):
         with timing("Evaluated recognition model"):
             grammars = {}
             for task in tasks:
@@ -492,7 +493,9 @@ class RecognitionModel(nn.Module):
                                         solver=solver,
                                         frontierSize=frontierSize, enumerationTimeout=enumerationTimeout,
                                         CPUs=CPUs, maximumFrontier=maximumFrontier,
-                                        evaluationTimeout=evaluationTimeout)
+                                        evaluationTimeout=evaluationTimeout,
+                                        budgetScheduler=budgetScheduler,
+                                        observationalEquivalence=observationalEquivalence)
 
 class RecurrentFeatureExtractor(nn.Module):
     def __init__(self, _=None,
@@ -10,11 +10,10 @@ open Task
 open Grammar
 open Task
 open FastType
+open Wire
 
-let load_problem channel =
+let load_grammar g =
   let open Yojson.Basic.Util in
-  let j = Yojson.Basic.from_channel channel in
-  let g = j |> member "DSL" in
   let logVariable = g |> member "logVariable" |> to_float in
   let productions = g |> member "productions" |> to_list |> List.map ~f:(fun p ->
     let source = p |> member "expression" |> to_string in
@@ -27,9 +26,10 @@ let load_problem channel =
       let logProbability = p |> member "logProbability" |> to_float in
       (e,t,logProbability,compile_unifier t))
       in
-  (* Successfully parsed the grammar *)
-  let g = {logVariable = logVariable; library = productions;} in
+  {logVariable = logVariable; library = productions;}
 
+let load_problem g j =
+  let open Yojson.Basic.Util in
   let e = j |> member "examples" |> to_list in
 
   let guess_type elements =
@@ -116,7 +116,7 @@ let load_problem channel =
     in
 
   let differentiable =
-    productions |> List.exists ~f:(fun (e,_,_,_) -> is_base_primitive e && "REAL" = primitive_name e)
+    g.library |> List.exists ~f:(fun (e,_,_,_) -> is_base_primitive e && "REAL" = primitive_name e)
   in
 
   let verbose = try
@@ -124,6 +124,11 @@ let load_problem channel =
                   with _ -> false
   in
 
+  let streamSolutions = try
+    j |> member "streamSolutions" |> to_bool
+                  with _ -> false
+  in
+
   let maximum_frontier = j |> member "maximumFrontier" |> to_int in
   let name = j |> member "name" |> to_string in
 
@@ -170,7 +175,13 @@ let load_problem channel =
   in
   (t,g,
    lowerBound,upperBound,budgetIncrement,
-   maximum_frontier,verbose)
+   maximum_frontier,verbose,streamSolutions)
+
+let serialize_solution (p,lp,ll,t) : Yojson.Basic.json =
+  `Assoc([("program", `String(string_of_program p));
+          ("time", `Float(t));
+          ("logLikelihood", `Float(ll));
+          ("logPrior", `Float(lp))])
 
 let export_frontier program_count solutions : string =
   (* solutions |> List.iter ~f:(fun (p,_,_,_) -> *)
@@ -180,15 +191,60 @@ let export_frontier program_count solutions : string =
   let open Yojson.Basic in
   let serialization : Yojson.Basic.json =
     `Assoc([("programCount", `Int(program_count));
-          ("solutions", `List(solutions |> List.map ~f:(fun (p,lp,ll,t) ->
-            `Assoc([("program", `String(string_of_program p));
-                       ("time", `Float(t));
-                       ("logLikelihood", `Float(ll));
-                       ("logPrior", `Float(lp))]))))])
+          ("solutions", `List(solutions |> List.map ~f:serialize_solution))])
   in pretty_to_string serialization
 
+let solve ~binary g index j =
+  let (t,g,
+     lowerBound,upperBound,budgetIncrement,
+     maximumFrontier,verbose,streamSolutions) =
+       load_problem g j in
+  (* Only binary replies can stream their solutions *)
+  let onHit =
+    if streamSolutions && binary then stream_wire_solution index
+    else (fun _ _ _ _ -> ())
+  in
+  let (solutions, program_count) =
+    enumerate_for_task ~lowerBound:lowerBound ~upperBound:upperBound ~budgetIncrement:budgetIncrement
+    ~onHit:onHit ~verbose:verbose ~maximumFrontier:maximumFrontier g t
+  in
+  if binary then export_wire_frontier index program_count solutions
+  else export_frontier program_count solutions |> print_string
+
+(* solver --server: jobs arrive one after the other as binary messages in
+   frames on stdin, each answered just like a single binary request.
+   A grammar is sent once along with the number that later jobs use to
+   name it, and is kept until the frontend says to forget it. SIGUSR1
+   stops the job being run, even if it arrives before the enumeration
+   starts; one that arrives between jobs is forgotten. *)
+let serve () =
+  let open Yojson.Basic.Util in
+  let grammars = Caml.Hashtbl.create 8 in
+  let rec loop () =
+    match read_frame Caml.stdin with
+    | None -> ()
+    | Some(message) ->
+      stop_requested := false ;
+      let j = decode_message message in
+      (match j |> member "forgetGrammars" with
+       | `List(forgotten) -> forgotten |> List.iter ~f:(fun k -> Caml.Hashtbl.remove grammars (to_int k))
+       | _ -> ()) ;
+      let grammar_id = j |> member "grammarId" |> to_int in
+      if not (Caml.Hashtbl.mem grammars grammar_id) then begin
+        let g = j |> member "DSL" |> load_grammar in
+        Caml.Hashtbl.replace grammars grammar_id (g, production_index g)
+      end ;
+      let (g, index) = Caml.Hashtbl.find grammars grammar_id in
+      solve ~binary:true g index j ;
+      loop ()
+  in loop ()
+
 let _ =
 
+  (* We might be asked to stop (SIGUSR1) before we start enumerating. Do
+     not die, but stop as soon as we do start. *)
+  remember_requests_to_stop () ;
+
   Caml.Sys.set_signal
     Caml.Sys.sigusr2
     (Caml.Sys.Signal_handle
@@ -204,13 +260,11 @@ let _ =
             (Caml.Printexc.get_callstack 100)) ;
         failwith "Show the trace please")) ;
 
-  let (t,g,
-     lowerBound,upperBound,budgetIncrement,
-     maximumFrontier,verbose) =
-       load_problem stdin in
-  let (solutions, program_count) =
-    enumerate_for_task ~lowerBound:lowerBound ~upperBound:upperBound ~budgetIncrement:budgetIncrement
-    ~verbose:verbose ~maximumFrontier:maximumFrontier g t
-  in
-  export_frontier program_count solutions |> print_string ;;
-
+  if Caml.Array.mem "--server" Caml.Sys.argv then serve () else begin
+    (* Either JSON, or the binary format of wire.ml, in which case we also reply in binary *)
+    let message = In_channel.input_all In_channel.stdin in
+    let binary = is_wire_message message in
+    let j = if binary then decode_message message else Yojson.Basic.from_string message in
+    let g = j |> Yojson.Basic.Util.member "DSL" |> load_grammar in
+    solve ~binary:binary g (production_index g) j
+  end ;;
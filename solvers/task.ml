@@ -15,6 +15,15 @@ type task =
 
 exception EnumerationTimeout
 
+(* Whether we have been asked to stop (SIGUSR1) at a time when we could
+   not: outside of enumerate_for_task, which then stops straight away, or
+   while it was reporting a hit. Whoever reads a new job clears it. *)
+let stop_requested = ref false
+
+let remember_requests_to_stop () =
+  Caml.Sys.set_signal Caml.Sys.sigusr1
+    (Caml.Sys.Signal_handle (fun _ -> stop_requested := true))
+
 let supervised_task ?timeout:(timeout = 0.001) name ty examples =
   { name = name    ;
     task_type = ty ;
@@ -121,6 +130,7 @@ let score_programs_for_task (f:frontier) (t:task) : frontier =
   }
 
 let enumerate_for_task (g: grammar) ?verbose:(verbose = true)
+    ?onHit:(onHit = (fun _ _ _ _ -> ()))
     ?budgetIncrement:(budgetIncrement = 1.)
     ?lowerBound:(lowerBound = 0.)
     ?upperBound:(upperBound = 99.)
@@ -142,14 +152,24 @@ let enumerate_for_task (g: grammar) ?verbose:(verbose = true)
 
   let startTime = Time.now () in
 
+  (* A request to stop that arrives while a hit is being reported is only
+     acted upon once it has been written: raising in the middle of a frame
+     would leave a partial message on the stream *)
+  let reporting = ref false in
+
   let listenForSIGUSR1 =
     Caml.Sys.Signal_handle (
-      fun _ -> raise EnumerationTimeout
+      fun _ -> if !reporting then stop_requested := true else raise EnumerationTimeout
     ) in
 
-  Caml.Sys.set_signal Caml.Sys.sigusr1 listenForSIGUSR1 ;
+  (* Once we are done enumerating, requests to stop are only remembered *)
+  let stopListening () =
+    stop_requested := false ;
+    remember_requests_to_stop () in
 
   try
+    Caml.Sys.set_signal Caml.Sys.sigusr1 listenForSIGUSR1 ;
+    if !stop_requested then raise EnumerationTimeout ;
     while Heap.length hits < maximumFrontier
        && !lower_bound +. budgetIncrement <= upperBound
     do
@@ -171,6 +191,10 @@ let enumerate_for_task (g: grammar) ?verbose:(verbose = true)
                       |> Time.Span.to_sec in
              Heap.add hits (p,logPrior,logLikelihood,dt) ;
              if Heap.length hits > maximumFrontier then Heap.remove_top hits ;
+             reporting := true ;
+             onHit p logPrior logLikelihood dt ;
+             reporting := false ;
+             if !stop_requested then raise EnumerationTimeout ;
              if verbose then
                Printf.eprintf
                 "\t(ocaml) HIT %s w/ %s\n" (t.name) (string_of_program p)
@@ -189,5 +213,6 @@ let enumerate_for_task (g: grammar) ?verbose:(verbose = true)
         flush_everything();
       end else ()
     done ;
+    stopListening () ;
     (Heap.to_list hits, !programs_explored)
-  with EnumerationTimeout -> (Heap.to_list hits, !programs_explored)
+  with EnumerationTimeout -> (stopListening () ; (Heap.to_list hits, !programs_explored))
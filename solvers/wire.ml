@@ -0,0 +1,148 @@
+(* Binary messages exchanged with the Python frontend: see wireFormat.py *)
+open Core
+
+open Program
+open Grammar
+
+let magic = "ECW1"
+
+let is_wire_message (message : string) : bool =
+  Caml.String.length message >= 4 && Caml.String.sub message 0 4 = magic
+
+(* Little endian, like struct.pack("<...") *)
+let read_uint32 (s : string) (offset : int) : int =
+  let byte j = Caml.Char.code (Caml.String.get s (offset + j)) in
+  (byte 0) lor ((byte 1) lsl 8) lor ((byte 2) lsl 16) lor ((byte 3) lsl 24)
+
+let read_int64 (s : string) (offset : int) : Int64.t =
+  let rec loop j accumulator =
+    if j < 0 then accumulator else
+      loop (j - 1)
+        (Caml.Int64.logor (Caml.Int64.shift_left accumulator 8)
+           (Caml.Int64.of_int (Caml.Char.code (Caml.String.get s (offset + j)))))
+  in loop 7 0L
+
+(* Two's complement integer of the given number of bytes *)
+let read_signed (s : string) (offset : int) (width : int) : int =
+  let rec loop j accumulator =
+    if j < 0 then accumulator else
+      loop (j - 1) ((accumulator lsl 8) lor (Caml.Char.code (Caml.String.get s (offset + j))))
+  in
+  let n = loop (width - 1) 0 in
+  if n >= 1 lsl (8*width - 1) then n - (1 lsl (8*width)) else n
+
+let add_uint32 (b : Caml.Buffer.t) (n : int) : unit =
+  for j = 0 to 3 do
+    Caml.Buffer.add_char b (Caml.Char.chr ((n lsr (8*j)) land 255))
+  done
+
+let add_int64 (b : Caml.Buffer.t) (n : Int64.t) : unit =
+  for j = 0 to 7 do
+    Caml.Buffer.add_char b
+      (Caml.Char.chr (Caml.Int64.to_int (Caml.Int64.logand (Caml.Int64.shift_right_logical n (8*j)) 255L)))
+  done
+
+let add_float (b : Caml.Buffer.t) (f : float) : unit =
+  add_int64 b (Caml.Int64.bits_of_float f)
+
+(* Decodes a message into the JSON that the Python frontend would otherwise have sent *)
+let decode_message (message : string) : Yojson.Basic.json =
+  let position = ref (Caml.String.length magic) in
+  let next_byte () =
+    let c = Caml.String.get message !position in
+    incr position; c
+  in
+  let next_uint32 () =
+    let n = read_uint32 message !position in
+    position := !position + 4; n
+  in
+  let next_int64 () =
+    let n = read_int64 message !position in
+    position := !position + 8; n
+  in
+  let next_signed width () =
+    let n = read_signed message !position width in
+    position := !position + width; `Int(n)
+  in
+  let next_string () =
+    let n = next_uint32 () in
+    let s = Caml.String.sub message !position n in
+    position := !position + n; s
+  in
+  let repeat n f =
+    let rec loop k accumulator =
+      if k = 0 then List.rev accumulator else loop (k - 1) (f () :: accumulator)
+    in loop n []
+  in
+  let rec next_value () : Yojson.Basic.json =
+    match next_byte () with
+    | 'n' -> `Null
+    | 't' -> `Bool(true)
+    | 'f' -> `Bool(false)
+    | 'i' -> `Int(Caml.Int64.to_int (next_int64 ()))
+    | 'd' -> `Float(Caml.Int64.float_of_bits (next_int64 ()))
+    | 's' -> `String(next_string ())
+    | 'l' -> `List(repeat (next_uint32 ()) next_value)
+    | 'B' -> `List(repeat (next_uint32 ()) (next_signed 1))
+    | 'H' -> `List(repeat (next_uint32 ()) (next_signed 2))
+    | 'W' -> `List(repeat (next_uint32 ()) (next_signed 4))
+    | 'I' -> `List(repeat (next_uint32 ()) (fun () -> `Int(Caml.Int64.to_int (next_int64 ()))))
+    | 'D' -> `List(repeat (next_uint32 ()) (fun () -> `Float(Caml.Int64.float_of_bits (next_int64 ()))))
+    | 'm' -> `Assoc(repeat (next_uint32 ()) (fun () ->
+        let k = next_string () in
+        (k, next_value ())))
+    | c -> raise (Failure ("decode_message: unknown tag " ^ Caml.String.make 1 c))
+  in
+  next_value ()
+
+(* Programs are sent in preorder: productions by their index in the grammar,
+   lambdas as -1, applications as -2, and $i as -3-i *)
+let production_index (g : grammar) : (string, int) Caml.Hashtbl.t =
+  let index = Caml.Hashtbl.create 100 in
+  List.iteri g.library ~f:(fun j (p,_,_,_) -> Caml.Hashtbl.replace index (string_of_program p) j) ;
+  index
+
+let encode_program (index : (string, int) Caml.Hashtbl.t) (p : program) : int list =
+  let rec encode p accumulator =
+    match p with
+    | Abstraction(b) -> -1 :: encode b accumulator
+    | Apply(f,x) -> -2 :: encode f (encode x accumulator)
+    | Index(j) -> (-3 - j) :: accumulator
+    | Primitive(_,_,_) | Invented(_,_) ->
+      Caml.Hashtbl.find index (string_of_program p) :: accumulator
+  in encode p []
+
+let add_solution index (b : Caml.Buffer.t) (p,lp,ll,t) : unit =
+  add_float b t; add_float b ll; add_float b lp;
+  let codes = encode_program index p in
+  add_uint32 b (List.length codes);
+  List.iter codes ~f:(fun c -> add_uint32 b (c land 0xFFFFFFFF))
+
+let write_frame (b : Caml.Buffer.t) : unit =
+  let header = Caml.Buffer.create 4 in
+  add_uint32 header (Caml.Buffer.length b);
+  Caml.print_string (Caml.Buffer.contents header);
+  Caml.print_string (Caml.Buffer.contents b)
+
+let stream_wire_solution index p lp ll t =
+  let b = Caml.Buffer.create 64 in
+  Caml.Buffer.add_char b 's';
+  add_solution index b (p,lp,ll,t);
+  write_frame b;
+  Caml.flush Caml.stdout
+
+let export_wire_frontier index program_count solutions =
+  let b = Caml.Buffer.create 1024 in
+  Caml.Buffer.add_char b 'f';
+  add_int64 b (Caml.Int64.of_int program_count);
+  add_uint32 b (List.length solutions);
+  List.iter solutions ~f:(add_solution index b);
+  write_frame b;
+  Caml.flush Caml.stdout
+
+(* One frame from the channel, or None at end of file *)
+let read_frame (channel : Caml.in_channel) : string option =
+  try
+    let header = Caml.really_input_string channel 4 in
+    Some(Caml.really_input_string channel (read_uint32 header 0))
+  with End_of_file -> None
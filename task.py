@@ -2,14 +2,175 @@ from .program import *
 from .utilities import *
 from .differentiation import *
 
+import os
+import pickle
 import random
 import signal
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
 
 class EvaluationTimeout(Exception): pass
 
-EVALUATIONTABLE = {}
+class EvaluationTimer(object):
+    """
+    Interrupts programs that evaluate for too long, without any system
+    calls per program. While the timer is armed, a SIGVTALRM arrives every
+    timeout seconds of CPU time. A program that is still being evaluated
+    at the second tick after it began gets an EvaluationTimeout, so every
+    program gets between timeout and twice timeout seconds.
+    Arm the timer once around many evaluations (eg all of enumeration),
+    and bracket each evaluation with begin() and end().
+    """
+    def __init__(self):
+        self.timeout = None
+        # Number of evaluations that have begun
+        self.evaluations = 0
+        self.evaluating = False
+        self.evaluationsAtLastTick = None
 
+    def tick(self, _1, _2):
+        if not self.evaluating: return
+        if self.evaluations == self.evaluationsAtLastTick:
+            # Only interrupt once
+            self.evaluating = False
+            raise EvaluationTimeout()
+        self.evaluationsAtLastTick = self.evaluations
 
+    @contextmanager
+    def armed(self, timeout):
+        if self.timeout is not None or timeout is None:
+            yield
+            return
+        previousHandler = signal.signal(signal.SIGVTALRM, self.tick)
+        signal.setitimer(signal.ITIMER_VIRTUAL, timeout, timeout)
+        self.timeout = timeout
+        try: yield
+        finally:
+            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+            signal.signal(signal.SIGVTALRM,
+                          previousHandler if previousHandler is not None else (lambda *_: None))
+            self.timeout = None
+            self.evaluating = False
+
+    def begin(self):
+        self.evaluations += 1
+        self.evaluating = True
+    def end(self):
+        self.evaluating = False
+
+EVALUATIONTIMER = EvaluationTimer()
+
+class EvaluationCache(object):
+    """
+    Remembers the outputs of programs on inputs, for tasks which ask for it.
+    The most recently used entries are kept in memory, up to capacity.
+    Optionally (see useSharedStore) every entry is also kept in an sqlite
+    database, which is shared by every process using the same path (eg
+    enumeration workers) and which outlives them (eg across iterations).
+    """
+    def __init__(self, capacity=10**6):
+        self.capacity = capacity
+        self.table = OrderedDict()
+        self.path = None
+        self.storeCapacity = None
+        # Connections can't be shared with forked children, so each
+        # process opens its own
+        self.connection = None
+        self.connectionPID = None
+        self.insertions = 0
+
+        self.hits = 0
+        self.storeHits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["connection"] = None
+        state["connectionPID"] = None
+        return state
+
+    def __str__(self):
+        lookups = self.hits + self.storeHits + self.misses
+        return "EvaluationCache(%d entries in memory, %d hits in memory, %d hits in the shared store, %d misses: hit rate %.1f%%)"%\
+            (len(self.table), self.hits, self.storeHits, self.misses,
+             100.*(self.hits + self.storeHits)/max(lookups, 1))
+
+    def useSharedStore(self, path, capacity=10**7):
+        """path: None to stop using the shared store"""
+        if path != self.path:
+            self.connection = None
+            self.connectionPID = None
+        self.path = path
+        self.storeCapacity = capacity
+
+    def store(self):
+        if self.path is None: return None
+        if self.connectionPID != os.getpid():
+            import sqlite3
+            self.connection = sqlite3.connect(self.path, timeout=60., isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=OFF")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS evaluations (key TEXT PRIMARY KEY, output BLOB, used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS recency ON evaluations (used)")
+            self.connectionPID = os.getpid()
+        return self.connection
+
+    @staticmethod
+    def storeKey(program, x):
+        # Python's hash is salted per interpreter, so the shared store is
+        # keyed by the text of the program and of the input
+        import hashlib
+        return hashlib.sha1(("%s\t%r"%(program, x)).encode()).hexdigest()
+
+    def remember(self, key, output):
+        self.table[key] = output
+        self.table.move_to_end(key)
+        if len(self.table) > self.capacity: self.table.popitem(last=False)
+
+    def lookup(self, program, x):
+        """Returns (True, output) if we know the output of program on x, and (False, None) otherwise"""
+        key = (x, program)
+        if key in self.table:
+            self.table.move_to_end(key)
+            self.hits += 1
+            return True, self.table[key]
+
+        store = self.store()
+        if store is not None:
+            storeKey = EvaluationCache.storeKey(program, x)
+            row = store.execute("SELECT output FROM evaluations WHERE key = ?", (storeKey,)).fetchone()
+            if row is not None:
+                store.execute("UPDATE evaluations SET used = ? WHERE key = ?", (time(), storeKey))
+                output = pickle.loads(row[0])
+                self.remember(key, output)
+                self.storeHits += 1
+                return True, output
+
+        self.misses += 1
+        return False, None
+
+    def record(self, program, x, output):
+        self.remember((x, program), output)
+
+        store = self.store()
+        if store is None: return
+        try: output = pickle.dumps(output)
+        except: return
+        store.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?)",
+                      (EvaluationCache.storeKey(program, x), output, time()))
+        # Every once in a while, forget the least recently used entries
+        self.insertions += 1
+        if self.insertions%1000 == 0:
+            n = store.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+            if n > self.storeCapacity:
+                store.execute("DELETE FROM evaluations WHERE key IN (SELECT key FROM evaluations ORDER BY used LIMIT ?)",
+                              (n - self.storeCapacity,))
+
+EVALUATIONTABLE = EvaluationCache()
+
+
+@sharedWithCompiledWorkers
 class Task(object):
     def __init__(self, name, request, examples, features=None, cache=False):
         '''request: the type of this task
@@ -45,34 +206,64 @@ class Task(object):
         for a in x: f = f(a)
         return f
     def check(self, e, timeout=None):
-        if timeout is not None:
-            def timeoutCallBack(_1,_2): raise EvaluationTimeout()
-            signal.signal(signal.SIGVTALRM, timeoutCallBack)
-            signal.setitimer(signal.ITIMER_VIRTUAL, timeout)
-            
+        if timeout is not None and EVALUATIONTIMER.timeout is None:
+            with EVALUATIONTIMER.armed(timeout): return self.check(e, timeout)
+
         try:
-            f = e.evaluate([])
+            if timeout is not None: EVALUATIONTIMER.begin()
+            f = e.compile()([])
             
             for x,y in self.examples:
-                if self.cache and (x,e) in EVALUATIONTABLE: p = EVALUATIONTABLE[(x,e)]
-                else:
+                if self.cache: hit, p = EVALUATIONTABLE.lookup(e, x)
+                else: hit = False
+                if not hit:
                     try: p = self.predict(f,x)
                     except: p = None
-                    if self.cache: EVALUATIONTABLE[(x,e)] = p
-                if p != y:
-                    if timeout is not None:
-                        signal.signal(signal.SIGVTALRM, lambda *_:None)
-                        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
-                    return False
-
-            if timeout is not None:
-                signal.signal(signal.SIGVTALRM, lambda *_:None)
-                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+                    if self.cache: EVALUATIONTABLE.record(e, x, p)
+                if p != y: return False
             return True
         except EvaluationTimeout:
             eprint("Timed out while evaluating", e)
             return False
+        finally:
+            if timeout is not None: EVALUATIONTIMER.end()
         
+    def checkMany(self, programs, timeout=None):
+        """Same as [self.check(e, timeout) for e in programs].
+        Programs that come out of the enumerator share lots of
+        applications, eg (f x y) and (f x z) share (f x), so we evaluate
+        each application once per example and share it across the programs."""
+        if self.cache or type(self).check is not Task.check or type(self).predict is not Task.predict:
+            return [ self.check(e, timeout) for e in programs ]
+        if timeout is not None and EVALUATIONTIMER.timeout is None:
+            with EVALUATIONTIMER.armed(timeout): return self.checkMany(programs, timeout)
+
+        numberOfArguments = len(self.request.functionArguments())
+        # Inside of the lambdas for the arguments, $0 is the last argument
+        environments = [ list(reversed(x)) for x,_ in self.examples ]
+        memos = [ {} for _ in self.examples ]
+
+        def check(e):
+            body = e
+            for _ in range(numberOfArguments):
+                if not body.isAbstraction: return self.check(e, timeout)
+                body = body.body
+
+            try:
+                if timeout is not None: EVALUATIONTIMER.begin()
+                for (_,y), environment, memo in zip(self.examples, environments, memos):
+                    try: p = body.evaluateWithMemo(environment, memo)
+                    except: p = None
+                    if p != y: return False
+                return True
+            except EvaluationTimeout:
+                eprint("Timed out while evaluating", e)
+                return False
+            finally:
+                if timeout is not None: EVALUATIONTIMER.end()
+
+        return [ check(e) for e in programs ]
+
     def logLikelihood(self,e, timeout=None):
         if self.check(e, timeout): return 0.0
         else: return NEGATIVEINFINITY
@@ -1,14 +1,20 @@
 
 
 
+from .utilities import restoreSlots
+
 class UnificationFailure(Exception): pass
 class Occurs(UnificationFailure): pass
 
 class Type(object):
+    # Type inference allocates lots of these
+    __slots__ = []
+    def __setstate__(self, state): restoreSlots(self, state)
     def __str__(self): return self.show(True)
     def __repr__(self): return str(self)
 
 class TypeConstructor(Type):
+    __slots__ = ["name", "arguments", "isPolymorphic"]
     def __init__(self, name, arguments):
         self.name = name
         self.arguments = arguments
@@ -72,6 +78,7 @@ class TypeConstructor(Type):
 
 
 class TypeVariable(Type):
+    __slots__ = ["v", "isPolymorphic"]
     def __init__(self,j):
         assert isinstance(j,int)
         self.v = j
@@ -87,9 +94,9 @@ class TypeVariable(Type):
     def functionArguments(self): return []
 
     def apply(self, context):
-        for v,t in context.substitution:
-            if v == self.v: return t.apply(context)
-        return self
+        t = context.substitution.get(self.v, None)
+        if t is None: return self
+        return t.apply(context)
 
     def occurs(self,v): return v == self.v
 
@@ -114,12 +121,79 @@ class TypeVariable(Type):
     
             
 
+class Substitution(object):
+    """
+    A persistent map from type variables to types. It is a trie of tuples
+    of WIDTH entries, indexed by successive bits of the variable (negative
+    variables interleaved with the others), whose leaves are the types.
+    set copies the path down to the variable and shares everything else,
+    so both lookups and updates take time logarithmic in the largest
+    variable, however many bindings there are.
+    """
+    BITS = 5
+    WIDTH = 1 << BITS
+    MASK = WIDTH - 1
+    __slots__ = ["root", "shift"]
+    def __init__(self, root=None, shift=0):
+        self.root = Substitution.EMPTYNODE if root is None else root
+        # Bits of the key below those indexing the root
+        self.shift = shift
+
+    def get(self, v, default=None):
+        k = v + v if v >= 0 else -1 - v - v
+        shift = self.shift
+        if k >> shift >= Substitution.WIDTH: return default
+        node = self.root
+        while shift:
+            node = node[(k >> shift) & Substitution.MASK]
+            if node is None: return default
+            shift -= Substitution.BITS
+        t = node[k & Substitution.MASK]
+        return default if t is None else t
+
+    def __contains__(self, v): return self.get(v) is not None
+
+    def set(self, v, t):
+        """A new substitution, which also binds v to t"""
+        k = v + v if v >= 0 else -1 - v - v
+        root = self.root
+        shift = self.shift
+        while k >> shift >= Substitution.WIDTH:
+            root = (root,) + Substitution.EMPTYNODE[1:]
+            shift += Substitution.BITS
+        return Substitution(Substitution._set(root, shift, k, t), shift)
+
+    @staticmethod
+    def _set(node, shift, k, t):
+        i = (k >> shift) & Substitution.MASK
+        if shift: t = Substitution._set(node[i] or Substitution.EMPTYNODE, shift - Substitution.BITS, k, t)
+        return node[:i] + (t,) + node[i + 1:]
+
+    def items(self):
+        def walk(node, shift, prefix):
+            for i, child in enumerate(node):
+                if child is None: continue
+                k = prefix | (i << shift)
+                if shift: yield from walk(child, shift - Substitution.BITS, k)
+                else: yield (k >> 1 if k & 1 == 0 else -1 - (k >> 1)), child
+        return walk(self.root, self.shift, 0)
+
+    def __setstate__(self, state): restoreSlots(self, state)
+
+Substitution.EMPTYNODE = (None,)*Substitution.WIDTH
+
 class Context(object):
-    def __init__(self, nextVariable=0, substitution=[]):
+    """
+    A substitution from type variables to types, and the next fresh variable.
+    Contexts are never modified in place: extend returns a new context,
+    which shares most of its substitution with the old one.
+    """
+    __slots__ = ["nextVariable", "substitution"]
+    def __init__(self, nextVariable=0, substitution=None):
         self.nextVariable = nextVariable
-        self.substitution = substitution
+        self.substitution = Substitution.EMPTY if substitution is None else substitution
     def extend(self,j,t):
-        return Context(self.nextVariable, [(j,t)] + self.substitution)
+        return Context(self.nextVariable, self.substitution.set(j, t))
     def makeVariable(self):
         return (Context(self.nextVariable + 1, self.substitution),
                 TypeVariable(self.nextVariable))
@@ -145,10 +219,19 @@ class Context(object):
     def __str__(self):
         return "Context(next = %d, {%s})"%(self.nextVariable,
                                            ", ".join("t%d ||> %s"%(k,v.apply(self))
-                                                     for k,v in self.substitution ))
+                                                     for k,v in self.substitution.items() ))
     def __repr__(self): return str(self)
-
-Context.EMPTY = Context(0,[])
+    def __setstate__(self, state):
+        restoreSlots(self, state)
+        # Contexts pickled when substitutions were lists or dictionaries
+        if not isinstance(self.substitution, Substitution):
+            substitution = Substitution.EMPTY
+            for v, t in dict(self.substitution).items():
+                substitution = substitution.set(v, t)
+            self.substitution = substitution
+
+Substitution.EMPTY = Substitution()
+Context.EMPTY = Context(0)
 
 def canonicalTypes(ts):
     bindings = {}
@@ -9,6 +9,8 @@ import os
 import subprocess
 import math
 import pickle as pickle
+import threading
+import weakref
 from itertools import chain
 
 
@@ -23,6 +25,16 @@ class Bunch(object):
     def __getitem__(self, key):
         return self.__dict__[key]
 
+def restoreSlots(self, state):
+    """
+    __setstate__ for classes with __slots__, which also accepts the
+    __dict__ pickled by versions of the class that didn't have slots
+    """
+    if isinstance(state, tuple):
+        dictionary, slots = state
+        state = dict(dictionary or {}, **(slots or {}))
+    for k, v in state.items(): setattr(self, k, v)
+
 def hashable(v):
     """Determine whether `v` can be hashed."""
     try:
@@ -52,7 +64,8 @@ PARALLELMAPDATA = None
 def parallelMap(numberOfCPUs, f, *xs, chunksize=None, maxtasksperchild=None):
     global PARALLELMAPDATA
 
-    if numberOfCPUs == 1: return map(f,*xs)
+    # A list either way, as callers go over the results more than once
+    if numberOfCPUs == 1: return list(map(f,*xs))
 
     n = len(xs[0])
     for x in xs: assert len(x) == n
@@ -189,6 +202,214 @@ def _launchParallelProcess():
 
 class CompiledTimeout(Exception): pass
 
+# Objects of these classes are pickled only once, into OBJECTSTORE.
+# Requests to compiled workers refer to them by the digest of that pickle,
+# which the worker loads from the store the first time that it sees it,
+# and replies that mention them come back as our own objects. So they
+# should not change once they have been given to callCompiled.
+SHAREDWITHCOMPILEDWORKERS = []
+# Whether objects of each type are shared, forgotten whenever a class is added
+SHAREDTYPES = {}
+def sharedWithCompiledWorkers(cls):
+    """Class decorator: see SHAREDWITHCOMPILEDWORKERS"""
+    SHAREDWITHCOMPILEDWORKERS.append(cls)
+    SHAREDTYPES.clear()
+    return cls
+
+def _isSharedWithCompiledWorkers(obj):
+    t = type(obj)
+    shared = SHAREDTYPES.get(t)
+    if shared is None:
+        shared = SHAREDTYPES[t] = any( issubclass(t, c) for c in SHAREDWITHCOMPILEDWORKERS )
+    return shared
+
+class ObjectStore(object):
+    """
+    Pickles in a directory, named by the digest of their contents. The
+    directory belongs to the process that imported this module first and
+    is shared with everything that it forks and launches. That process
+    deletes a pickle once none of its objects have that digest anymore,
+    and the whole directory when it exits. Directories left behind by
+    processes that died without cleaning up are deleted by the next
+    store to create its own.
+    """
+    PREFIX = "ecObjectStore-"
+
+    def __init__(self):
+        import tempfile
+        self.directory = os.path.join(tempfile.gettempdir(), "%s%d"%(ObjectStore.PREFIX, os.getpid()))
+        self.owner = os.getpid()
+        # id(x) -> (weak reference to x, digest of x)
+        self.digests = {}
+        # digest -> {id(x): weak reference to x} for our objects x with that digest
+        self.objects = {}
+        import atexit
+        atexit.register(self.clear)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def put(self, obj):
+        """Stores obj unless it is already there, and returns its digest"""
+        import hashlib
+        key = id(obj)
+        entry = self.digests.get(key)
+        # Processes forked from the owner may have objects whose pickles
+        # the owner has since deleted, and then they put them back
+        if entry is not None and entry[0]() is obj and \
+           (os.getpid() == self.owner or os.path.exists(self.path(entry[1]))):
+            return entry[1]
+
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            if not os.path.exists(self.directory):
+                self.removeStaleDirectories()
+                os.makedirs(self.directory, exist_ok=True)
+            # Readers only ever see complete files
+            temporary = "%s.%d"%(path, os.getpid())
+            with open(temporary, "wb") as handle: handle.write(data)
+            os.replace(temporary, path)
+
+        def collected(reference, key=key, digest=digest, store=self):
+            if store.digests.get(key, (None,))[0] is reference: del store.digests[key]
+            holders = store.objects.get(digest)
+            if holders is not None and holders.get(key) is reference:
+                del holders[key]
+                if len(holders) == 0:
+                    del store.objects[digest]
+                    store.evict(digest)
+        reference = weakref.ref(obj, collected)
+        self.digests[key] = (reference, digest)
+        self.objects.setdefault(digest, {})[key] = reference
+        return digest
+
+    def get(self, digest):
+        """Our object with this digest, or None if we have none"""
+        for reference in self.objects.get(digest, {}).values():
+            obj = reference()
+            if obj is not None: return obj
+        return None
+
+    def load(self, digest):
+        with open(self.path(digest), "rb") as handle:
+            return pickle.load(handle)
+
+    def evict(self, digest):
+        """Deletes the pickle of an object that nobody can ask for again"""
+        if os.getpid() != self.owner: return
+        try: os.remove(self.path(digest))
+        except OSError: pass
+
+    def removeStaleDirectories(self):
+        import shutil
+        parent = os.path.dirname(self.directory)
+        try: names = os.listdir(parent)
+        except OSError: return
+        for name in names:
+            if not name.startswith(ObjectStore.PREFIX): continue
+            try: pid = int(name[len(ObjectStore.PREFIX):])
+            except ValueError: continue
+            try: os.kill(pid, 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+            except OSError: pass
+
+    def clear(self):
+        if os.getpid() == self.owner:
+            import shutil
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+OBJECTSTORE = ObjectStore()
+
+class CompiledWorker(object):
+    """
+    A pypy3 compiledDriver.py process that runs one request after another,
+    keeping its JIT warm along with the objects that it has been sent.
+    Requests and replies are pickles; see SHAREDWITHCOMPILEDWORKERS.
+    """
+    def __init__(self, command):
+        self.process = subprocess.Popen(command,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.pid = self.process.pid
+        # Digests of the shared objects that the worker has loaded
+        self.shipped = set()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def send(self, request):
+        worker = self
+        class Pickler(pickle.Pickler):
+            def persistent_id(self, obj):
+                if not _isSharedWithCompiledWorkers(obj): return None
+                digest = OBJECTSTORE.put(obj)
+                worker.shipped.add(digest)
+                return digest
+
+        # Each request comes after the location of the store, and the
+        # objects that the worker can drop because we no longer have them
+        forgotten = [ digest for digest in self.shipped if OBJECTSTORE.get(digest) is None ]
+        self.shipped.difference_update(forgotten)
+        pickle.dump((OBJECTSTORE.directory, forgotten), self.process.stdin)
+        Pickler(self.process.stdin).dump(request)
+        self.process.stdin.flush()
+
+    def receive(self):
+        """The next message from the worker, with shared objects resolved to ours"""
+        class Unpickler(pickle.Unpickler):
+            def persistent_load(self, digest):
+                obj = OBJECTSTORE.get(digest)
+                if obj is None: obj = OBJECTSTORE.load(digest)
+                return obj
+        return Unpickler(self.process.stdout).load()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (OSError, ValueError): pass
+
+class CompiledWorkerPool(object):
+    """
+    The compiled workers of this process. A worker is busy while it runs a
+    request, so concurrent calls get different workers; there are only as
+    many workers as there have been concurrent calls. Workers forked from
+    the process that started them are not reused.
+    """
+    def __init__(self, command=['pypy3', 'compiledDriver.py']):
+        self.command = command
+        self.idle = []
+        self.owner = os.getpid()
+        self.lock = threading.Lock()
+        self.startups = 0
+
+    def acquire(self, pypyArgs=[]):
+        """A worker to run a request on, which should then be given to release"""
+        if pypyArgs:
+            self.startups += 1
+            return CompiledWorker(self.command[:1] + pypyArgs + self.command[1:])
+        with self.lock:
+            if self.owner != os.getpid():
+                self.idle = []
+                self.owner = os.getpid()
+            while self.idle:
+                worker = self.idle.pop()
+                if worker.alive(): return worker
+            self.startups += 1
+        return CompiledWorker(self.command)
+
+    def release(self, worker, reuse=True):
+        if reuse and worker.alive():
+            with self.lock:
+                if self.owner == os.getpid():
+                    self.idle.append(worker)
+                    return
+        worker.close()
+
+COMPILEDWORKERS = CompiledWorkerPool()
+
 def callCompiled(f, *arguments, **keywordArguments):
     pypyArgs = []
     profile = keywordArguments.pop('profile', None)
@@ -199,37 +420,58 @@ def callCompiled(f, *arguments, **keywordArguments):
 
     timeout = keywordArguments.pop('compiledTimeout', None)
 
-    p = subprocess.Popen(['pypy3'] + pypyArgs + ['compiledDriver.py'],
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    
+    # f may report intermediate results by calling whatever is passed
+    # to it as the keyword argument streamKeyword; those calls are
+    # forwarded to streamCallBack in this process as they happen
+    streamKeyword = keywordArguments.pop("streamKeyword", None)
+    streamCallBack = keywordArguments.pop("streamCallBack", None)
+
+    worker = COMPILEDWORKERS.acquire(pypyArgs)
+
     if PIDCallBack is not None:
-        PIDCallBack(p.pid)
-    
+        PIDCallBack(worker.pid)
+
+    # The worker uses the same shared evaluation store as we do
+    from .task import EVALUATIONTABLE
     request = {
         "function": f,
         "arguments": arguments,
         "keywordArguments": keywordArguments,
+        "streamKeyword": streamKeyword,
+        "evaluationCache": (EVALUATIONTABLE.path, EVALUATIONTABLE.storeCapacity),
     }
     start = time.time()
-    pickle.dump(request, p.stdin)
+    worker.send(request)
     dt = time.time() - start
     if dt > 1:
         eprint("(Python side of compiled driver: SLOW) Wrote serialized message for {} in time {}".format(f.__name__, dt))
 
-    if timeout is None:
-        success, result = pickle.load(p.stdout)
-    else:
+    def response():
+        while True:
+            message = worker.receive()
+            if message[0] == "stream": streamCallBack(*message[1])
+            else: return message
+
+    # Running out of time kills the worker, which cuts the response short
+    expired = []
+    def expire():
+        expired.append(True)
+        worker.process.kill()
+    if timeout is not None:
         eprint("Running with timeout",timeout)
-        def timeoutCallBack(_1,_2): raise CompiledTimeout()
-        signal.signal(signal.SIGALRM, timeoutCallBack)
-        signal.alarm(int(math.ceil(timeout)))
-        try:
-            success, result = pickle.load(p.stdout)
-            signal.alarm(0)
-        except CompiledTimeout:
-            # Kill the process
-            p.kill()
-            raise CompiledTimeout()
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+    try:
+        success, result = response()
+    except BaseException as e:
+        worker.process.kill()
+        worker.close()
+        if expired and isinstance(e, (EOFError, pickle.UnpicklingError)): raise CompiledTimeout()
+        raise
+    finally:
+        if timeout is not None: timer.cancel()
+
+    COMPILEDWORKERS.release(worker, reuse=not pypyArgs)
 
     if not success:
         sys.exit(1)
@@ -0,0 +1,149 @@
+"""
+Binary messages exchanged with the OCaml solver (solvers/wire.ml).
+
+The request is a tree of tagged values, mirroring the JSON that the solver
+used to receive: the solver decodes it into the same tree. Lists of numbers,
+eg the examples of list tasks, are packed in bulk.
+
+The solver replies with length prefixed frames, one per streamed solution
+followed by one holding the whole frontier. Programs are sent in preorder as
+codes: a nonnegative code is the index of a production in the grammar that
+we sent, and negative codes are lambdas, applications and de Bruijn indices.
+So solutions come back as programs without being printed and parsed.
+"""
+
+from .program import *
+
+import struct
+
+MAGIC = b"ECW1"
+
+# Lists of integers are packed with the narrowest of these that fits them
+INTEGERARRAYS = [(b"B", "b"), (b"H", "h"), (b"W", "i"), (b"I", "q")]
+
+ABSTRACTIONCODE = -1
+APPLICATIONCODE = -2
+# Index i is sent as INDEXCODE - i
+INDEXCODE = -3
+
+
+def encodeMessage(message):
+    parts = [MAGIC]
+    encodeValue(message, parts)
+    return b"".join(parts)
+
+
+# Packing formats are compiled once. The formats of arrays are cached by
+# (code, length), as messages hold lots of lists of the same length.
+HEADER = struct.Struct("<cI")
+INTEGER = struct.Struct("<cq")
+FLOAT = struct.Struct("<cd")
+ARRAYFORMATS = {}
+def arrayFormat(code, n):
+    f = ARRAYFORMATS.get((code, n))
+    if f is None:
+        f = ARRAYFORMATS[(code, n)] = struct.Struct("<cI%d%s" % (n, code))
+    return f
+
+# Each key of a map, with its length in front
+KEYS = {}
+def encodeKey(k):
+    e = KEYS.get(k)
+    if e is None:
+        e = k.encode("utf-8")
+        e = KEYS[k] = struct.pack("<I", len(e)) + e
+    return e
+
+
+def encodeValue(v, parts):
+    t = type(v)
+    if v is None: parts.append(b"n")
+    elif t is bool: parts.append(b"t" if v else b"f")
+    elif t is int: parts.append(INTEGER.pack(b"i", v))
+    elif t is float: parts.append(FLOAT.pack(b"d", v))
+    elif t is str:
+        v = v.encode("utf-8")
+        parts.append(HEADER.pack(b"s", len(v)))
+        parts.append(v)
+    elif t is dict:
+        parts.append(HEADER.pack(b"m", len(v)))
+        for k, x in v.items():
+            parts.append(encodeKey(k))
+            encodeValue(x, parts)
+    else:
+        if t is not list and t is not tuple: v = list(v)
+        types = set(map(type, v))
+        if types == {int}:
+            # Trying the narrowest first is cheaper than finding the range
+            for tag, code in INTEGERARRAYS:
+                try:
+                    parts.append(arrayFormat(code, len(v)).pack(tag, len(v), *v))
+                    return
+                except struct.error: continue
+            raise ValueError("Integers beyond 64 bits cannot be sent to the solver: %s" % v)
+        elif types == {float}:
+            parts.append(arrayFormat("d", len(v)).pack(b"D", len(v), *v))
+            return
+        parts.append(HEADER.pack(b"l", len(v)))
+        for x in v: encodeValue(x, parts)
+
+
+def frames(data):
+    """Splits a byte string into the payloads of its frames"""
+    offset = 0
+    while offset + 4 <= len(data):
+        n, = struct.unpack_from("<I", data, offset)
+        yield data[offset + 4:offset + 4 + n]
+        offset += 4 + n
+
+
+def readFrame(handle):
+    """Reads one frame from a file, returning its payload, or None at end of file"""
+    header = handle.read(4)
+    if len(header) < 4: return None
+    n, = struct.unpack("<I", header)
+    return handle.read(n)
+
+
+def decodeProgram(codes, productions):
+    # Postorder over the reversed preorder: every node's children are on the stack
+    stack = []
+    for c in reversed(codes):
+        if c >= 0: stack.append(productions[c])
+        elif c == ABSTRACTIONCODE: stack.append(Abstraction(stack.pop()))
+        elif c == APPLICATIONCODE:
+            f = stack.pop()
+            x = stack.pop()
+            stack.append(Application(f, x))
+        else: stack.append(Index(INDEXCODE - c))
+    assert len(stack) == 1
+    return stack[0]
+
+
+def decodeSolution(payload, offset, productions):
+    """Returns ({"program", "time", "logLikelihood", "logPrior"}, offset of what follows)"""
+    time, logLikelihood, logPrior, n = struct.unpack_from("<dddI", payload, offset)
+    offset += 28
+    codes = struct.unpack_from("<%di" % n, payload, offset)
+    return {"program": decodeProgram(codes, productions),
+            "time": time,
+            "logLikelihood": logLikelihood,
+            "logPrior": logPrior}, offset + 4*n
+
+
+def decodeStreamedSolution(payload, productions):
+    """Returns the solution in a streamed frame, or None if it's some other kind of frame"""
+    if payload[:1] != b"s": return None
+    return decodeSolution(payload, 1, productions)[0]
+
+
+def decodeFrontier(payload, productions):
+    """Returns the final frame as {"programCount", "solutions"}"""
+    assert payload[:1] == b"f"
+    programCount, n = struct.unpack_from("<qI", payload, 1)
+    offset = 13
+    solutions = []
+    for _ in range(n):
+        solution, offset = decodeSolution(payload, offset, productions)
+        solutions.append(solution)
+    return {"programCount": programCount, "solutions": solutions}